@@ -53,7 +53,8 @@ public:
     std::vector<std::string> TwoParamFunctions {"list_add", "list_add_tail", "list_move_tail",
                                                 "list_add_rcu", "list_add_tail_rcu", "hlist_add_head",
                                                 "hlist_add_before", "hlist_add_behind", "hlist_add_head_rcu",
-                                                "hlist_add_tail_rcu", "hlist_add_before_rcu"};
+                                                "hlist_add_tail_rcu", "hlist_add_before_rcu",
+                                                "hlist_bl_add_head", "hlist_bl_add_head_rcu"};
     
     std::vector<std::string> OneParamFunctions {"list_del", "list_del_rcu"};
     // "list_del_init", "list_del_init_rcu"};
@@ -12,7 +12,6 @@ from graph_tool.all import *
 from ram import *
 from graph_utils import *
 
-NR_CPUS = 4
 KERNEL_COUNT = 85
 
 def label_struct(s):
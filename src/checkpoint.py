@@ -0,0 +1,62 @@
+import os
+import time
+import pickle
+import logging
+import utils
+
+# Periodic checkpoints of a long exploration. A checkpoint is taken
+# between two structs, when the sample file contains exactly the structs
+# already walked, and saves what is needed to continue from there: the
+# pending worklist and its shadow_worklist, the dereferenceability
+# caches and the offset of the sample file. On resume the sample file
+# is truncated at that offset, dropping the structs dumped after the
+# checkpoint (and a pickle possibly left half written).
+
+# Structs walked between two checkpoints
+CHECKPOINT_EVERY = 200000
+
+class Checkpoint:
+
+    def __init__(self, path, every=CHECKPOINT_EVERY):
+        self.path = path
+        self.every = every
+        self.global_structs_addr = set()
+
+    def maybe_save(self, i, worklist, sample):
+        if i and i % self.every == 0:
+            self.save(worklist, sample)
+
+    def save(self, worklist, sample):
+        start = time.time()
+        state = {"worklist": worklist.get_state(),
+                 "sample_offset": sample.tell(),
+                 "sample_counter": sample.counter,
+                 "global_structs_addr": self.global_structs_addr,
+                 "dereferenceable_cache": utils.dereferenceable_cache,
+                 "not_dereferenceable_cache": utils.not_dereferenceable_cache}
+
+        # Never leave a half written checkpoint behind
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+        logging.info("[+] Checkpoint: %d structs dumped, %d pending (%.2fs)" %
+                     (sample.counter, len(worklist), time.time() - start))
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    # Restores the state saved in the worklist and in the utils caches.
+    def restore(self, state, worklist):
+        worklist.set_state(state["worklist"])
+        self.global_structs_addr = state["global_structs_addr"]
+        utils.dereferenceable_cache.update(state["dereferenceable_cache"])
+        utils.not_dereferenceable_cache.update(state["not_dereferenceable_cache"])
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
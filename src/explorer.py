@@ -1,3 +1,5 @@
+import struct
+import tracing
 from mytypes import *
 from utils import *
 
@@ -15,82 +17,264 @@ RB_INFO = {("struct mm_struct", "mm_rb"): ("struct vm_area_struct", "vm_rb"),
            ("struct eventpoll", "rbr"): ("struct epitem", "rbn"),
            ("struct proc_dir_entry", "subdir"): ("struct proc_dir_entry", "subdir_node"),
            ("struct cfs_rq", "tasks_timeline"): ("struct sched_entity", "run_node")}
+
+# hlist_bl_head roots, for the pointer info extracted before the clang
+# plugin knew about hlist_bl_add_head.
+HLIST_BL_INFO = {("struct super_block", "s_anon"): ("struct dentry", "d_hash"),
+                 # From 4.16
+                 ("struct super_block", "s_roots"): ("struct dentry", "d_hash")}
                 
+# The containers walked by the Explorer, by type of their head.
+# walker is the Explorer method walking them (walk_<walker>), the
+# other keys are its parameters:
+#  - root: path of the pointer to the first node, from the head
+#  - mask: bits of the first pointer used as flags
+#  - node, slots: type of the internal nodes and their array of entries
+#  - internal_mask, internal_tag: tag of the entries pointing to nodes
+#  - value_tag: tag of the entries which are values, not pointers
+#  - nested: field of the head which is the actual container
+CONTAINERS = {
+    "struct list_head": {"name": "list_head", "walker": "list"},
+    "struct hlist_head": {"name": "hlist_head", "walker": "hlist", "mask": 0},
+    # The lowest bit of first is a lock
+    "struct hlist_bl_head": {"name": "hlist_bl_head", "walker": "hlist", "mask": 1},
+    "struct rb_root": {"name": "rb_tree", "walker": "rb", "root": ("rb_node",)},
+    "struct rb_root_cached": {"name": "rb_tree_cached", "walker": "rb",
+                              "root": ("rb_root", "rb_node")},
+    # Up to 4.19: nodes are tagged with 1, exceptional entries with 2
+    "struct radix_tree_root": {"name": "radix_tree", "walker": "radix", "root": ("rnode",),
+                               "node": "struct radix_tree_node", "slots": "slots",
+                               "internal_mask": 3, "internal_tag": 1, "value_tag": 2},
+    # From 4.20: nodes are tagged with 2, values with 1
+    "struct xarray": {"name": "xarray", "walker": "radix", "root": ("xa_head",),
+                      "node": "struct xa_node", "slots": "slots",
+                      "internal_mask": 3, "internal_tag": 2, "value_tag": 1},
+    "struct idr": {"name": "idr", "walker": "nested", "nested": "idr_rt"},
+}
+
+# Type of the entries of radix trees, xarrays and IDRs.
+# TODO: get this information automatically from the clang plugin
+RADIX_INFO = {("struct address_space", "page_tree"): "struct page",
+              ("struct address_space", "i_pages"): "struct page",
+              ("struct pid_namespace", "idr"): "struct pid",
+              ("struct ipc_ids", "ipcs_idr"): "struct kern_ipc_perm",
+              ("struct kernfs_root", "ino_idr"): "struct kernfs_node",
+              ("struct cgroup_root", "cgroup_idr"): "struct cgroup",
+              ("struct irq_domain", "revmap_tree"): "struct irq_data"}
+
+# How to go from the node of a container, identified by (struct type,
+# field name, array index), to the struct containing the next node: the
+# pointee type and the offset of its node. Following a plan, a list
+# costs one read of the next pointer per hop.
+class TraversalPlan:
+
+    def __init__(self, struct_type, field_name, pointee_type, pointee_field_name, offset):
+        self.struct_name = "casted_from_%s.%s" % (struct_type, field_name)
+        self.pointee_type = pointee_type
+        self.pointee_type_str = str(pointee_type)
+        self.pointee_pointer = pointee_type.pointer()
+        self.pointee_field_name = pointee_field_name
+        self.offset = offset
+
+# Plans only depend on the types: they are kept across the snapshots of
+# a session. None when the plan cannot be resolved.
+traversal_plans = {}
+
 class Explorer():
     def __init__(self,  node_info, pointer_info, global_structs_addr):
-        self.node_info = node_info
-        self.pointer_info = pointer_info
+        # Copies: the node and pointer info of the Loader are shared by
+        # all the snapshots of a session
+        self.node_info = dict(node_info)
+        self.pointer_info = dict(pointer_info)
         self.global_structs_addr = global_structs_addr
-        self.per_cpu_offsets = gdb.lookup_symbol("__per_cpu_offset")[0].value()
+        # Set by locate_struct.py (see profiler.py)
+        self.profiler = None
+        self.offsets = {}
+        self.types = {}
 
         for k, v in RB_INFO.items():
             assert(k not in self.pointer_info)
             self.pointer_info[k] = v
+
+        for k, v in HLIST_BL_INFO.items():
+            if k not in self.node_info:
+                self.node_info[k] = Node.ROOT
+                self.pointer_info[k] = v
+
+        for t, n in self.pointer_info:
+            self.get_plan(t, n, log=False)
             
     def handle(self, struct_type, field_name, value, array_index):
-        works = []
-
-        if str(value.type) == "struct list_head":
-            works = self.handle_list_head(struct_type, field_name, value,
-                                          array_index=array_index)
-        elif str(value.type) == "struct hlist_head":
-            works = self.handle_hlist_head(struct_type, field_name, value)
-        elif str(value.type) == "struct rb_root":
-            works = self.handle_rb_tree(struct_type, field_name, value)
-        elif str(value.type) == "struct rb_root_cached":
-            works = self.handle_rb_tree(struct_type, field_name, value, True)
-            
+        kind = CONTAINERS.get(type_info(value.type).str)
+        if kind is None:
+            return []
+
+        works = self.profiled(kind["name"],
+                              self.walk(kind, struct_type, field_name, value, array_index))
         if works:
             return works
         else:
             return []
 
+    def walk(self, kind, struct_type, field_name, value, array_index=-1):
+        walker = getattr(self, "walk_%s" % kind["walker"])
+        return walker(kind, struct_type, field_name, value, array_index)
+
+    def walk_list(self, kind, struct_type, field_name, value, array_index):
+        return self.handle_list_head(struct_type, field_name, value, array_index=array_index)
+
+    def walk_hlist(self, kind, struct_type, field_name, value, array_index):
+        return self.handle_hlist_head(struct_type, field_name, value, kind["mask"])
+
+    def walk_rb(self, kind, struct_type, field_name, value, array_index):
+        return self.handle_rb_tree(struct_type, field_name, value, kind["root"])
+
+    def walk_radix(self, kind, struct_type, field_name, value, array_index):
+        return self.handle_radix_tree(struct_type, field_name, value, kind)
+
+    def walk_nested(self, kind, struct_type, field_name, value, array_index):
+        nested = value[kind["nested"]]
+        inner = CONTAINERS.get(type_info(nested.type).str)
+        if inner is None:
+            logging.error("Unknown container %s in %s" % (nested.type, value.type))
+            return None
+        return self.walk(inner, struct_type, field_name, nested, array_index)
+
+    # Offset of the member at path (a tuple of field names) in type t.
+    def member_offset(self, t, path):
+        key = (str(t), path)
+        try:
+            return self.offsets[key]
+        except KeyError:
+            pass
+
+        v = gdb.Value(0).cast(t.pointer()).dereference()
+        for f in path:
+            v = v[f]
+        offset = int(v.address)
+        self.offsets[key] = offset
+        return offset
+
+    def profiled(self, kind, works):
+        if works and self.profiler is not None:
+            return self.profiler.handler(kind, works)
+        return works
+
     def handle_percpu_field(self, field, field_name):
-        for i in range(NR_CPUS):
-            offset = self.per_cpu_offsets[i]
-            field_type = field.type
-            long_type = gdb.lookup_type("u64")
-            try:
-                field_value = field.cast(long_type)
-            except gdb.MemoryError:
-                field_value = int(field.address) # Global percpu
-
-            translated = (offset.cast(long_type) + field_value).cast(field_type)
-            yield gdb_value_to_int(offset), "PERCPU_%d_%s" % (i, field_name), translated
-        
-    def handle_rb_tree(self, struct_type, field_name, field, is_rb_cached=False):
-        if is_rb_cached:
-            field = field["rb_root"]
-            
-        if gdb_value_to_int(field["rb_node"]) == 0:
+        field_type = field.type
+        field_value = gdb_value_to_int(field)
+        if field_value == -1:
+            field_value = int(field.address) # Global percpu
+
+        for i, offset, addr in per_cpu.translate(field_value):
+            yield offset, "PERCPU_%d_%s" % (i, field_name), gdb.Value(addr).cast(field_type)
+
+    # The nodes are read raw, one read per node.
+    def handle_rb_tree(self, struct_type, field_name, field, root=("rb_node",)):
+        rb_node = read_int(int(field.address) + self.member_offset(field.type, root), 8)
+        if rb_node == 0 or rb_node == -1:
             logging.debug("rb_node is zero, tree is empty")
             return
 
-        pointee_struct_type, pointee_field_name = self.get_pointer_info(struct_type, field_name)
-        if pointee_struct_type is None:
+        plan = self.get_plan(struct_type, field_name)
+        if plan is None:
             return
 
-        logging.debug("Walking a tree rooted at %s.%s which contains %s" % (struct_type, field_name, pointee_struct_type))
-        
-        nodes = [field["rb_node"]]
-        struct_type_ptr = pointee_struct_type.pointer()
-        for rb_node_ptr in nodes:
+        logging.debug("Walking a tree rooted at %s.%s which contains %s" % (struct_type, field_name, plan.pointee_type_str))
+
+        rb_node_type = gdb.lookup_type("struct rb_node")
+        rb_node_size = int(rb_node_type.sizeof)
+        children = [self.member_offset(rb_node_type, (i,)) for i in ["rb_right", "rb_left"]]
+        offset = plan.offset
 
-            pte_struct = container_of(rb_node_ptr, struct_type_ptr, pointee_field_name).dereference()
-            wname = "RB_NODE_%s.%s" % (pointee_struct_type, pointee_field_name)
+        nodes = [rb_node]
+        visited = set([rb_node])
+        struct_type_ptr = plan.pointee_pointer
+        wname = "RB_NODE_%s.%s" % (plan.pointee_type_str, plan.pointee_field_name)
+        for rb_node in nodes:
+
+            pte_struct = gdb.Value(rb_node - offset).cast(struct_type_ptr).dereference()
             yield wname, pte_struct
 
-            for i in ["rb_right", "rb_left"]:
-                rb_node = rb_node_ptr[i]
-                if not is_fetchable(rb_node):
-                    logging.error("Cannot fetch RB_NODE %s" % i)
+            b = read_memory(rb_node, rb_node_size)
+            if b is None:
+                logging.error("Cannot fetch RB_NODE @ 0x%016x" % rb_node)
+                continue
+
+            for i in children:
+                rb_node_addr = struct.unpack_from('<Q', b, i)[0]
+                if rb_node_addr and rb_node_addr not in visited:
+                    visited.add(rb_node_addr)
+                    nodes.append(rb_node_addr)
+
+    # Radix trees, xarrays (and IDRs, which are built on them). The
+    # nodes are read raw, one read per node, and walked depth first.
+    def handle_radix_tree(self, struct_type, field_name, field, kind):
+        entry_type = RADIX_INFO.get((struct_type, field_name))
+        if entry_type is None:
+            logging.debug("[MISSING_INFO] Missing radix info for %s.%s" % (struct_type, field_name))
+            return
+
+        root = read_int(int(field.address) + self.member_offset(field.type, kind["root"]), 8)
+        if root == 0 or root == -1:
+            return
+
+        try:
+            entry_ptr, node_size, slots_offset, slots = self.radix_types(entry_type, kind)
+        except gdb.error as e:
+            logging.error("Cannot walk %s.%s: %s" % (struct_type, field_name, e))
+            return
+
+        mask = kind["internal_mask"]
+        tag = kind["internal_tag"]
+        value_tag = kind["value_tag"]
+        wname = "RADIX_ENTRY_%s.%s" % (struct_type, field_name)
+
+        logging.debug("Walking a radix tree rooted at %s.%s which contains %s" % (struct_type, field_name, entry_type))
+
+        stack = [root]
+        visited = set()
+        while stack:
+            entry = stack.pop()
+
+            if (entry & mask) == tag:
+                node = entry & ~mask
+                # Retry and sibling entries are not nodes
+                if node < PAGE_SIZE or node in visited:
                     continue
+                visited.add(node)
 
-                rb_node_addr = gdb_value_to_int(rb_node.address)
+                b = read_memory(node, node_size)
+                if b is None:
+                    logging.error("Cannot fetch radix tree node @ 0x%016x" % node)
+                    continue
 
-                if rb_node and rb_node not in nodes:
-                    logging.debug("Found a good %s" % i)
-                    nodes.append(rb_node)
+                for e in reversed(slots.unpack_from(b, slots_offset)):
+                    # Sibling entries point inside the node itself
+                    if e and not (node <= (e & ~mask) < node + node_size):
+                        stack.append(e)
+
+            elif entry & value_tag:
+                continue
+
+            elif entry not in visited:
+                visited.add(entry)
+                yield wname, gdb.Value(entry).cast(entry_ptr).dereference()
+
+    def radix_types(self, entry_type, kind):
+        key = (entry_type, kind["node"])
+        try:
+            return self.types[key]
+        except KeyError:
+            pass
+
+        node_type = gdb.lookup_type(kind["node"])
+        slots_offset = self.member_offset(node_type, (kind["slots"],))
+        nslots = type_info(gdb.Value(0).cast(node_type.pointer()).dereference()[kind["slots"]].type).array_len
+        r = (gdb.lookup_type(entry_type).pointer(), int(node_type.sizeof), slots_offset,
+             struct.Struct('<%dQ' % nslots))
+        self.types[key] = r
+        return r
 
     def handle_global_head(self, name, struct_type, field_name):
         sym = gdb.lookup_symbol(name)[0] or gdb.lookup_global_symbol(name)
@@ -120,16 +304,32 @@ class Explorer():
             logging.error("[MISSING_INFO] Missing node info for %s.%s" % (t, n))
             return False
 
-    def get_pointer_info(self, t, n):
+    def get_plan(self, t, n, array_index=-1, log=True):
+        key = (t, n, array_index)
         try:
-            t, n = self.pointer_info[(t, n)]
-            return gdb.lookup_type(t), n
+            plan = traversal_plans[key]
         except KeyError:
+            plan = traversal_plans[key] = self.make_plan(t, n, array_index)
+
+        if plan is None and log:
             logging.error("[MISSING_INFO] Missing pointer info for %s.%s" % (t, n))
-            return None, None
+        return plan
+
+    def make_plan(self, t, n, array_index):
+        try:
+            pte, pte_field_name = self.pointer_info[(t, n)]
+            pte_type = gdb.lookup_type(pte)
+        except (KeyError, gdb.error):
+            return None
+
+        offset = find_offset(pte_type, pte_field_name, array_index=array_index)
+        if offset < 0:
+            logging.error("[-] Field not found: %s %s" % (pte, pte_field_name))
+            return None
+        return TraversalPlan(t, n, pte_type, pte_field_name, offset)
             
-    def handle_hlist_head(self, struct_type, field_name, field):
-        if is_empty_hlist(field):
+    def handle_hlist_head(self, struct_type, field_name, field, mask=0):
+        if is_empty_hlist(field, mask):
             logging.debug("first or first->next is 0, list is empty")
             return
 
@@ -137,7 +337,10 @@ class Explorer():
             return
 
         assert(self.node_info[(struct_type, field_name)] == Node.ROOT)
-        return self.explore_list(struct_type, field_name, 0, field['first'])
+        first = field['first']
+        if mask:
+            first = gdb.Value(gdb_value_to_int(first) & ~mask).cast(first.type)
+        return self.explore_list(struct_type, field_name, 0, first)
 
     def handle_list_head(self, struct_type, field_name, field, array_index=-1):
         if is_empty_list(field) or is_zero_list(field):
@@ -161,51 +364,41 @@ class Explorer():
 
     def explore_list(self, struct_type, field_name, head, gdb_next,  array_index = -1, one_step = False):
 
-        logging.debug("Exploring list from root: [0x%16x] %s.%s (i=%d)" %
-                      (head, struct_type, field_name, array_index))
-            
-        if gdb_value_to_int(gdb_next) in self.global_structs_addr:
-            logging.debug("Next points to a global structure, aborting here ")
+        tracing.record(tracing.LIST_START, 0, struct_type, field_name, head, array_index)
+
+        next_value = gdb_value_to_int(gdb_next)
+        if next_value in self.global_structs_addr:
+            tracing.record(tracing.LIST_GLOBAL)
             return
         
         visited = set([head])
 
-        while(head != gdb_value_to_int(gdb_next)):
+        while(head != next_value):
 
-            struct_name = "casted_from_%s.%s" % (struct_type, field_name)            
-            struct_type, field_name = self.get_pointer_info(str(struct_type), field_name)
-            
-            offset = find_offset(struct_type, field_name, array_index = array_index)
-            
-            if offset < 0:
-                logging.error("[-] Field not found: %s %s" % (struct_type, field_name))
+            plan = self.get_plan(str(struct_type), field_name, array_index)
+            if plan is None:
                 return
 
-            logging.debug("-> container_of gdb_next = 0x%016x offset = %d" %
-                          (gdb_value_to_int(gdb_next), offset))
-            
-            pte_struct = custom_container_of(gdb_next, struct_type.pointer(), offset).dereference()
+            tracing.record(tracing.LIST_CONTAINER, addr=next_value, value=plan.offset)
 
-            logging.debug("Cast 0x%016x: '%s' '%s'" % (gdb_value_to_int(pte_struct.address),
-                                                       struct_type, struct_name))
-            yield struct_name, pte_struct
+            addr = next_value - plan.offset
+            pte_struct = gdb.Value(addr).cast(plan.pointee_pointer).dereference()
+
+            tracing.record(tracing.LIST_CAST, 0, plan.pointee_type_str, plan.struct_name, addr)
+            yield plan.struct_name, pte_struct
 
             if one_step:
                 return
 
-            field = pte_struct[field_name]
-
-            if array_index >= 0 and is_array(field.type):
-                gdb_next = field[array_index]["next"]
-            else:
-                gdb_next = field["next"]
-
-            if not is_fetchable(gdb_next):
-                logging.error("Cannot fetch next %s.%s.." % (str(pte_struct.type), field_name))
-                return
+            struct_type, field_name = plan.pointee_type_str, plan.pointee_field_name
 
-            next_addr = gdb_value_to_int(gdb_next.address)
+            # next is the first field of list_head and hlist_node
+            next_addr = next_value
             if next_addr in visited: # LOOP ?
                 return
-
             visited.add(next_addr)
+
+            next_value = read_int(next_addr, 8)
+            if next_value == -1:
+                logging.error("Cannot fetch next %s.%s.." % (struct_type, field_name))
+                return
@@ -0,0 +1,376 @@
+import sys
+import bisect
+import asyncio
+import logging
+import argparse
+from memory import Memory, PAGE_SIZE, PAGE_MASK, PAGE_OFFSET
+
+# Client of the gdb remote serial protocol (the QEMU gdbstub), used for
+# the live explorations instead of the gdb remote target. gdb sends one
+# 'm' packet at a time and waits for its reply; here many 'm' packets
+# are kept in flight on the connection (the stub replies in order) and
+# the reads of adjacent ranges are merged into the largest packets the
+# stub accepts. The reads are served to the exploration through the
+# PageCache, which asks for batches of pages (see PageCache.prefetch).
+#
+# A stand-in stub serving a memory image is included, to run the client
+# without QEMU:
+# > python3 gdbstub.py serve ../dumps/server/sample0 --port 1234
+# > python3 gdbstub.py check ../dumps/server/sample0 --port 1234
+
+# Packets in flight on the connection
+MAX_INFLIGHT = 64
+
+# Used when the stub does not report its PacketSize (QEMU: 4096)
+DEFAULT_PACKET_SIZE = 4096
+
+# Seconds to wait for the reply of a packet
+TIMEOUT = 30
+
+class GdbStubError(Exception):
+    pass
+
+def checksum(data):
+    return b'%02x' % (sum(data) & 0xff)
+
+def frame(data):
+    return b'$' + data + b'#' + checksum(data)
+
+# Run length encoding: X*n is X repeated n - 29 more times
+def decode_rle(data):
+    if b'*' not in data:
+        return data
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c == ord('*') and out:
+            out += bytes([out[-1]]) * (data[i + 1] - 29)
+            i += 2
+            continue
+        out.append(c)
+        i += 1
+    return bytes(out)
+
+def unescape(data):
+    if b'}' not in data:
+        return data
+    out = bytearray()
+    it = iter(data)
+    for c in it:
+        if c == ord('}'):
+            c = next(it) ^ 0x20
+        out.append(c)
+    return bytes(out)
+
+async def read_packet(reader):
+    while True:
+        c = await reader.readexactly(1)
+        # Acks, before QStartNoAckMode
+        if c in (b'+', b'-'):
+            continue
+        if c in (b'$', b'%'):
+            break
+        logging.debug("gdbstub: unexpected byte %r" % c)
+
+    data = (await reader.readuntil(b'#'))[:-1]
+    cs = await reader.readexactly(2)
+    if cs != checksum(data):
+        raise GdbStubError("bad checksum in packet %r" % data[:32])
+    if c == b'%':
+        # Notifications are not replies
+        return await read_packet(reader)
+    return decode_rle(unescape(data))
+
+# 'O' followed by hex is the output of the target, never a reply (the
+# replies to 'm' are hex only, and OK is not hex)
+def is_console_output(data):
+    if len(data) < 3 or data[:1] != b'O':
+        return False
+    try:
+        bytes.fromhex(data[1:].decode())
+        return True
+    except ValueError:
+        return False
+
+# Largest power of two which is at most n
+def floor_pow2(n):
+    p = 1
+    while p * 2 <= n:
+        p *= 2
+    return p
+
+
+class GdbStubClient:
+
+    def __init__(self, host, port, max_inflight=MAX_INFLIGHT, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        # Set when the connection is lost: every request fails with it
+        self.error = None
+        self.inflight = None
+        self.pending = None
+        # Every packet is acknowledged until QStartNoAckMode
+        self.ack = True
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.max_read = 0
+        self.packets = 0
+        self.bytes = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Created here, in the loop which runs them
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.pending = asyncio.Queue()
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+        features = await self.request(b'qSupported:multiprocess-')
+        packet_size = DEFAULT_PACKET_SIZE
+        for f in features.split(b';'):
+            if f.startswith(b'PacketSize='):
+                packet_size = int(f[len(b'PacketSize='):], 16)
+
+        if b'QStartNoAckMode+' in features:
+            await self.request(b'QStartNoAckMode')
+            self.ack = False
+
+        # The reply is hex: two chars per byte. Reads never cross a page,
+        # so a failed read only loses an unmapped page.
+        self.max_read = min(floor_pow2(packet_size // 2), PAGE_SIZE)
+        logging.info("[+] gdbstub %s:%d: PacketSize %d, reads of %d bytes" %
+                     (self.host, self.port, packet_size, self.max_read))
+
+    # Replies arrive in the order of the requests
+    async def read_loop(self):
+        try:
+            while True:
+                data = await read_packet(self.reader)
+                if self.ack:
+                    self.writer.write(b'+')
+                if self.pending.empty() or is_console_output(data):
+                    logging.warning("gdbstub: unsolicited packet %r" % data[:32])
+                    continue
+                fut = self.pending.get_nowait()
+                if not fut.done():
+                    fut.set_result(data)
+        except Exception as e:
+            self.error = GdbStubError("connection lost: %r" % e)
+            self.fail_pending()
+            if not isinstance(e, (asyncio.IncompleteReadError, ConnectionError, GdbStubError)):
+                raise
+
+    def fail_pending(self):
+        while not self.pending.empty():
+            fut = self.pending.get_nowait()
+            if not fut.done():
+                fut.set_exception(self.error)
+
+    async def request(self, data):
+        async with self.inflight:
+            if self.error is not None:
+                raise self.error
+            fut = asyncio.get_event_loop().create_future()
+            self.pending.put_nowait(fut)
+            self.writer.write(frame(data))
+            self.packets += 1
+            await self.writer.drain()
+            try:
+                return await asyncio.wait_for(fut, self.timeout)
+            except asyncio.TimeoutError:
+                # The replies would not match the requests anymore
+                self.error = GdbStubError("no reply to %r in %ds" % (data[:32], self.timeout))
+                self.fail_pending()
+                raise self.error
+
+    async def read_chunk(self, addr, size):
+        reply = await self.request(b'm%x,%x' % (addr, size))
+        if not reply or reply.startswith(b'E'):
+            return None
+        b = bytes.fromhex(reply.decode())
+        if len(b) != size:
+            return None
+        self.bytes += size
+        return b
+
+    # Reads a list of (addr, size): the adjacent and overlapping ranges
+    # are merged and read with pipelined packets. Returns the bytes of
+    # every range, or None when a part of it cannot be read.
+    async def read_ranges(self, ranges):
+        merged = []
+        for addr, size in sorted(set(ranges)):
+            if merged and addr <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], addr + size)
+            else:
+                merged.append([addr, addr + size])
+
+        chunks = []
+        for start, end in merged:
+            a = start
+            while a < end:
+                n = min(end - a, self.max_read - (a % self.max_read))
+                chunks.append((a, n))
+                a += n
+
+        results = await asyncio.gather(*[self.read_chunk(a, n) for a, n in chunks])
+        starts = [a for a, _ in chunks]
+
+        out = []
+        for addr, size in ranges:
+            parts = []
+            a = addr
+            while a < addr + size:
+                # The chunk containing a: chunks are sorted and never
+                # cross a multiple of max_read
+                i = bisect.bisect_right(starts, a) - 1
+                ca, cn = chunks[i]
+                b = results[i]
+                n = min(addr + size, ca + cn) - a
+                parts.append(None if b is None else b[a - ca:a - ca + n])
+                a += n
+            out.append(None if None in parts else b''.join(parts))
+        return out
+
+    async def read(self, addr, size):
+        return (await self.read_ranges([(addr, size)]))[0]
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.write(frame(b'D'))
+        self.writer.close()
+        self.reader_task.cancel()
+        self.writer = None
+
+
+# Synchronous Memory on top of the client: every call runs the event
+# loop until its reads are done.
+class GdbStubMemory(Memory):
+
+    batched = True
+
+    def __init__(self, host, port, max_inflight=MAX_INFLIGHT):
+        self.loop = asyncio.new_event_loop()
+        self.client = GdbStubClient(host, port, max_inflight)
+        self.run(self.client.connect())
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def read(self, addr, size):
+        return self.run(self.client.read(addr, size))
+
+    def read_pages(self, pages):
+        pages = list(pages)
+        return dict(zip(pages, self.run(self.client.read_ranges([(p, PAGE_SIZE) for p in pages]))))
+
+    def read_physical_pages(self, paddrs):
+        paddrs = list(paddrs)
+        r = self.read_pages([PAGE_OFFSET + p for p in paddrs])
+        return {p: r[PAGE_OFFSET + p] for p in paddrs}
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.close()
+
+    def stats(self):
+        return ("gdbstub: %d packets, %d MiB read" %
+                (self.client.packets, self.client.bytes >> 20))
+
+
+# Stand-in for the QEMU gdbstub: serves the reads of a Memory (i.e. a
+# MemoryImage) with the same packets and limits.
+class GdbStubServer:
+
+    def __init__(self, memory, packet_size=DEFAULT_PACKET_SIZE):
+        self.memory = memory
+        self.packet_size = packet_size
+
+    async def handle(self, reader, writer):
+        ack = True
+        try:
+            while True:
+                data = await read_packet(reader)
+                if ack:
+                    writer.write(b'+')
+                reply = self.reply(data)
+                if data == b'QStartNoAckMode':
+                    ack = False
+                if reply is None:
+                    break
+                writer.write(frame(reply))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    def reply(self, data):
+        if data.startswith(b'qSupported'):
+            return b'PacketSize=%x;QStartNoAckMode+' % self.packet_size
+        if data == b'QStartNoAckMode':
+            return b'OK'
+        if data == b'?':
+            return b'S05'
+        if data.startswith(b'm'):
+            addr, size = [int(x, 16) for x in data[1:].split(b',')]
+            if size * 2 > self.packet_size:
+                return b'E22'
+            b = self.memory.read(addr, size)
+            if b is None:
+                return b'E14'
+            return b.hex().encode()
+        if data in (b'D', b'k'):
+            return None
+        # Unsupported packet
+        return b''
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info("[+] Serving on %s:%d" % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+# Compares the reads of the client with the image itself.
+def check(image, host, port, pages=4096):
+    memory = GdbStubMemory(host, port)
+    addrs = []
+    for start, end, _ in image.virtual_ranges:
+        addrs += range(start & PAGE_MASK, min(end, start + pages * PAGE_SIZE), PAGE_SIZE)
+        if len(addrs) >= pages:
+            break
+    addrs = addrs[:pages]
+
+    got = memory.read_pages(addrs)
+    bad = [a for a in addrs if got[a] != image.read(a, PAGE_SIZE)]
+    # Reads across pages and not aligned
+    for a in addrs[:64]:
+        if memory.read(a + 100, PAGE_SIZE) != image.read(a + 100, PAGE_SIZE):
+            bad.append(a + 100)
+
+    print("[+] %d pages read, %d mismatches. %s" % (len(addrs), len(bad), memory.stats()))
+    memory.close()
+    return not bad
+
+def main():
+    from memory import open_image
+
+    parser = argparse.ArgumentParser(description="Stand-in gdbstub serving a memory image")
+    parser.add_argument("command", choices=["serve", "check"])
+    parser.add_argument("image")
+    parser.add_argument("--kmap")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1234)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.INFO)
+    image = open_image(args.image, args.kmap)
+    if args.command == "serve":
+        asyncio.run(GdbStubServer(image).serve(args.host, args.port))
+    else:
+        sys.exit(0 if check(image, args.host, args.port) else 1)
+
+if __name__ == "__main__":
+    main()
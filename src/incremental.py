@@ -0,0 +1,115 @@
+import gdb
+import bisect
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from utils import *
+from mytypes import Sample
+
+# Incremental exploration of a snapshot, starting from the exploration
+# of a previous snapshot of the same machine. Every struct of the
+# previous sample whose pages did not change is copied as is to the new
+# sample and marked as visited, so the exploration stops there. A struct
+# touching dirty pages is walked again only if a clean struct points
+# inside it: the roots, and what the walks reach, are explored as usual,
+# and from them the exploration reaches the new structs.
+#
+# The result over-approximates a full exploration of the snapshot: a
+# clean struct which is no longer reachable in the new snapshot is
+# still kept, and the strings pointed by a clean struct are not read
+# again.
+
+# Finds the dirty structs which a clean struct points inside. Every
+# 8-byte word of the clean structs is taken as a possible pointer: the
+# fields of the sample do not keep the links of the embedded list_heads
+# and rb_nodes.
+class DirtyTargets:
+
+    def __init__(self, candidates):
+        # (addr, size, ...) sorted by address
+        self.candidates = sorted(candidates)
+        self.starts = [c[0] for c in self.candidates]
+        self.ends = [c[0] + c[1] for c in self.candidates]
+        if np is not None:
+            self.np_starts = np.array(self.starts, dtype=np.uint64)
+            self.np_ends = np.array(self.ends, dtype=np.uint64)
+        self.hit = set()
+
+    def scan(self, buf):
+        if not self.candidates:
+            return
+        n = len(buf) // 8
+        if np is None:
+            for w in memoryview(buf)[:n*8].cast('Q'):
+                i = bisect.bisect_right(self.starts, w) - 1
+                if i >= 0 and w < self.ends[i]:
+                    self.hit.add(i)
+            return
+
+        words = np.frombuffer(buf, dtype=np.uint64, count=n)
+        i = np.searchsorted(self.np_starts, words, side='right').astype(np.int64) - 1
+        inside = (i >= 0) & (words < self.np_ends[np.maximum(i, 0)])
+        self.hit.update(i[inside].tolist())
+
+    # Structs at the same address are all taken
+    def __iter__(self):
+        starts = set(self.starts[i] for i in self.hit)
+        for c in self.candidates:
+            if c[0] in starts:
+                yield c
+
+def reuse_sample(prev_path, diff, worklist, sample):
+    reused = 0
+    dirty = 0
+    types = dict()
+    clean = []
+    candidates = []
+
+    for s, raw in Sample.iter_raw(prev_path):
+        # Global roots and containers are seeded again by the Loader
+        if s.is_global():
+            continue
+
+        if worklist.is_visited(s.ty, s.addr):
+            continue
+
+        if not diff.is_dirty_range(s.addr, s.size):
+            sample.dump_raw(raw)
+            worklist.set_visited(s.ty, s.addr)
+            clean.append((s.addr, s.size))
+            reused += 1
+            continue
+
+        candidates.append((s.addr, s.size, s.ty, s.filename, s.name))
+
+    # The pages of the clean structs did not change
+    targets = DirtyTargets(candidates)
+    for addr, size in clean:
+        buf = read_memory(addr, size)
+        if buf is not None:
+            targets.scan(buf)
+
+    for addr, size, ty, filename, name in targets:
+        try:
+            t = types[(ty, filename)]
+        except KeyError:
+            try:
+                t = lookup_type(ty, filename)
+            except gdb.error:
+                logging.error("Cannot resolve type '%s' of the previous sample" % ty)
+                t = None
+            types[(ty, filename)] = t
+
+        if t is None:
+            continue
+
+        value = gdb.Value(addr).cast(t).dereference()
+        dirty += worklist.append(name, value)
+
+    logging.info("[+] Incremental: %d structs reused, %d of %d dirty ones to walk again. %s" %
+                 (reused, dirty, len(candidates), diff.stats()))
+    return reused, dirty
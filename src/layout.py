@@ -0,0 +1,164 @@
+import struct
+import logging
+from utils import *
+from mytypes import FieldAttr
+
+# A Layout is the flattened list of members of a struct type, as
+# returned by deep_items_anon, with everything that depends only on
+# the type computed once. Instances are then decoded from the raw
+# bytes of the struct.
+
+U64_MASK = 0xffffffffffffffff
+
+INT_FORMATS = {(1, False): '<B', (1, True): '<b',
+               (2, False): '<H', (2, True): '<h',
+               (4, False): '<I', (4, True): '<i',
+               (8, False): '<Q', (8, True): '<q'}
+
+# Same order of checks as Field.get_field_attr. Pointers have two
+# classes, chosen at decode time depending on the pointed memory.
+def classify(t):
+    ti = type_info(t)
+    if ti.is_array_of_struct:
+        return FieldAttr.ARRAY_OF_STRUCT, None
+    if ti.is_array_of_struct_pointer:
+        return FieldAttr.ARRAY_OF_STRUCT_PTR, None
+    if ti.is_array_of_char:
+        return FieldAttr.ARRAY_OF_CHAR, None
+    if ti.is_array_of_char_pointer:
+        return FieldAttr.ARRAY_OF_CHAR_PTR, None
+    if ti.is_struct:
+        return FieldAttr.STRUCT, None
+    if ti.is_function_pointer:
+        return FieldAttr.FUNC_PTR, FieldAttr.FUNC_PTR_NODEREF
+    if ti.is_pointer_of_pointer:
+        return FieldAttr.PTR_OF_PTR, FieldAttr.PTR_OF_PTR_NODEREF
+    if ti.is_struct_pointer:
+        return FieldAttr.STRUCT_PTR, FieldAttr.STRUCT_PTR_NODEREF
+    if ti.is_void_pointer:
+        return FieldAttr.VOID_PTR, FieldAttr.VOID_PTR_NODEREF
+    if ti.is_char_pointer:
+        return FieldAttr.CHAR_PTR, FieldAttr.CHAR_PTR_NODEREF
+    if ti.is_pointer:
+        return FieldAttr.PTR, FieldAttr.PTR_NODEREF
+    return FieldAttr.OTHER, None
+
+
+class Member:
+
+    def __init__(self, parent, name, path, t, offset, bitpos=0, bitsize=0):
+        self.name = name
+        # gdb.Fields to follow to get the gdb.Value of this member
+        self.path = path
+        self.type = t
+        self.offset = offset
+        self.bitpos = bitpos
+        self.bitsize = bitsize
+        self.size = int(t.sizeof)
+
+        ts = strip_typedefs_until_named(t)
+        self.ty = str(ts)
+        self.pte_type = str(resolve_type_ptr(t, named=True))
+        self.is_int = ts.code == gdb.TYPE_CODE_INT
+
+        ti = type_info(t)
+        self.attr, self.attr_noderef = classify(t)
+        self.is_pointer = ti.is_pointer
+        self.is_scalar = self.is_pointer or self.is_int
+        self.signed = ti.is_signed
+        self.format = INT_FORMATS.get((self.size, self.signed))
+        self.deref_size = ti.target_sizeof
+        self.array_len = ti.array_len
+
+        # Only these members can add work to the worklist or be
+        # walked by the Explorer, all the others are just decoded.
+        # Percpu pointers and arrays of pointers are walked whatever
+        # they point to.
+        self.needs_value = (self.attr in (FieldAttr.STRUCT, FieldAttr.STRUCT_PTR,
+                                          FieldAttr.ARRAY_OF_STRUCT, FieldAttr.ARRAY_OF_STRUCT_PTR) or
+                            (parent, name) in PERCPU_FIELDS or (parent, name) in PTR_OF_PTR_FIELDS)
+
+    def decode(self, buf):
+        if self.bitsize:
+            nbytes = (self.bitpos + self.bitsize + 7) // 8
+            v = int.from_bytes(buf[self.offset:self.offset+nbytes], 'little') >> self.bitpos
+            v &= (1 << self.bitsize) - 1
+            if self.signed and v >> (self.bitsize - 1):
+                v -= 1 << self.bitsize
+            return v & U64_MASK
+
+        if self.format is not None:
+            return struct.unpack_from(self.format, buf, self.offset)[0] & U64_MASK
+
+        return int.from_bytes(buf[self.offset:self.offset+self.size], 'little',
+                              signed=self.signed) & U64_MASK
+
+    def decode_array(self, buf):
+        return list(struct.unpack_from('<%dQ' % self.array_len, buf, self.offset))
+
+    def get_attr(self, value):
+        if self.attr_noderef is None:
+            return self.attr
+        if is_dereferenceable_addr(value, self.deref_size):
+            return self.attr
+        return self.attr_noderef
+
+    def value_of(self, gdb_struct):
+        v = gdb_struct
+        for f in self.path:
+            v = v[f]
+        return v
+
+    def __repr__(self):
+        return "Member : +0x%x %s %s [%s]" % (self.offset, self.ty, self.name, self.attr.name)
+
+
+# Mirrors deep_items_anon: anonymous structs are flattened and a union
+# which is the only field of an anonymous struct is replaced by the
+# struct itself (to preserve spinlock_t).
+def flatten(t, offset=0, path=(), prev=None):
+    fields = strip_typedefs_fast(t).fields()
+
+    for f in fields:
+        ft = f.type
+        field_offset = offset + f.bitpos // 8
+
+        if is_union(ft) and len(fields) == 1 and prev is not None:
+            yield prev
+            return
+
+        if is_struct(ft) and ft.tag is None and str(ft) == "struct {...}":
+            anon = (f.name, path + (f,), ft, field_offset, 0, 0)
+            for i in flatten(ft, field_offset, path + (f,), anon):
+                yield i
+        else:
+            yield (f.name, path + (f,), ft, field_offset, f.bitpos % 8, f.bitsize)
+
+
+class Layout:
+
+    def __init__(self, t):
+        self.ty = str(strip_typedefs_until_named(t))
+        self.size = int(t.sizeof)
+        self.members = [Member(self.ty, *m) for m in flatten(t)]
+
+    def __repr__(self):
+        r = "Layout : %s (size: %d)\n" % (self.ty, self.size)
+        for m in self.members:
+            r += "  %s\n" % m
+        return r
+
+
+layouts = {}
+
+def get_layout(t):
+    key = type_cache_key(t)
+    try:
+        return layouts[key]
+    except KeyError:
+        pass
+
+    layout = Layout(t)
+    layouts[key] = layout
+    logging.debug("Compiled %s" % layout)
+    return layout
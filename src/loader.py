@@ -9,12 +9,26 @@ import functools
 import os
 import json
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A new lazy value of the same symbol. gdb keeps the contents of the
+# values it fetched, which belong to the snapshot explored before.
+def fresh_value(v):
+    if v.address is None:
+        return v
+    return gdb.Value(int(v.address)).cast(v.type.pointer()).dereference()
+
 # POINTER_INFO is a dictionary where:
 # keys are ('pointer struct',  'pointer field')
 # items are ('pointee struct', 'pointee field')
 
 class Loader:
-    def __init__(self, KDIR):
+    # With roots, only the global symbols in roots are loaded as the
+    # roots of the exploration (bounded exploration).
+    def __init__(self, KDIR, roots=None):
         self.INFO_FILE = os.path.join(KDIR, "kernel_info.txt")
         # nm ./vmlinux  -l > System.map.line_number
         self.SYSTEM_MAP_FILE = os.path.join(KDIR, "System.map.line_numbers")
@@ -31,8 +45,16 @@ class Loader:
         self.NODE_INFO = {}
         self.GLOBAL_CONTAINERS = set()
         self.PERCPU_GLOBALS = {}
+        self.roots = set(roots) if roots is not None else None
+        # Symbols resolved by gdb (None when they do not exist) and the
+        # lines of System.map, kept across the snapshots of a session
+        self.symbols = {}
+        self.system_map = None
         self.load_info()
 
+    def is_root(self, name):
+        return self.roots is None or name in self.roots
+
     def load_info(self):
         print("[+] Loading pointer info")
         self.load_pointer_info()
@@ -41,14 +63,25 @@ class Loader:
 
         print("[+] Loading percpu globals")
         self.load_percpu_global_info()
+
+        assert(len(self.NODE_INFO) == len(self.POINTER_INFO))
+        self.load_snapshot()
+
+    # Everything which depends on the memory of the snapshot. In a
+    # session (see locate_struct.py) only this is loaded again for every
+    # snapshot.
+    def load_snapshot(self):
+        self.WORKLIST = Worklist()
+        self.GLOBAL_CONTAINERS = set()
+        for k, v in self.PERCPU_GLOBALS.items():
+            self.PERCPU_GLOBALS[k] = fresh_value(v)
+
         print("[+] Loading global hashtables")
         self.load_global_hashtables()
-        
+
         print("[+] Loading System.map")
         self.load_system_map()
 
-        assert(len(self.NODE_INFO) == len(self.POINTER_INFO))
-
     def load_percpu_global_info(self):
         r = re.compile("(.*):\d*:.*\(.*,(.*)\)")
         f = open(self.PERCPU_GLOBALS_FILE, 'r')
@@ -63,7 +96,7 @@ class Loader:
             filename = match.group(1).strip()
             name = match.group(2).strip()
 
-            if(filename, name) in self.PERCPU_GLOBALS:
+            if (filename, name) in self.PERCPU_GLOBALS or not self.is_root(name):
                 continue
 
             try:
@@ -217,8 +250,18 @@ class Loader:
             s = name
 
         try:
-            v = gdb.parse_and_eval(s)
-        except gdb.error:
+            v = self.symbols[s]
+        except KeyError:
+            try:
+                v = gdb.parse_and_eval(s)
+            except gdb.error:
+                v = None
+            self.symbols[s] = v
+        else:
+            if v is not None and not v.is_optimized_out:
+                v = fresh_value(v)
+
+        if v is None:
             logging.debug("[-] Failed to load symbol %s %s" % (name, filename))
             return None
 
@@ -262,14 +305,15 @@ class Loader:
         return int(sym_addr, 16), sym_type, sym_name, sym_filename
 
     def load_system_map(self):
-        f = open(self.SYSTEM_MAP_FILE, 'r')
+        if self.system_map is None:
+            with open(self.SYSTEM_MAP_FILE, 'r') as f:
+                self.system_map = [self.parse_system_map_line(line) for line in f]
         symbols = []
 
-        for line in f.readlines():
-            sym_addr, sym_type, sym_name, sym_filename = self.parse_system_map_line(line)
+        for sym_addr, sym_type, sym_name, sym_filename in self.system_map:
 
             if (self.skip_symbol(sym_type, sym_name) or sym_name in GLOBAL_HASHTABLES or
-                (sym_filename, sym_name) in self.PERCPU_GLOBALS):
+                (sym_filename, sym_name) in self.PERCPU_GLOBALS or not self.is_root(sym_name)):
                 continue
 
             sym = self.load_symbol(sym_name, sym_filename)
@@ -309,13 +353,11 @@ class Loader:
             for name, v in nv:
                 self.WORKLIST.append(name, v, is_global_work)
 
-            f.close()
-
     def load_global_hashtable(self, sym, sym_name, size, pte_type, pte_field_name, filename):
         orig_sym = sym
         
         if is_struct_pointer(sym.type):
-            array = sym.dereference().cast(sym.type.target().array(0, size - 1))
+            array = dereference(sym).cast(sym.type.target().array(0, size - 1))
             sym = sym.cast(sym.type.array(0, size - 1))
         else:
             array = sym
@@ -326,28 +368,59 @@ class Loader:
         pte_type = lookup_type(pte_type, filename)
         offset = find_offset(pte_type.target(), pte_field_name)
 
-        for name, value in list(walk_array(sym_name, array)):
-            elem = value["first"]
-            if gdb_value_to_int(elem) == 0:
-                f.add_array_element(0)
-                continue
+        firsts = self.read_hashtable_buckets(array, size)
+        if firsts is None:
+            logging.error("Cannot read the buckets of %s" % sym_name)
+            firsts = [gdb_value_to_int(value["first"]) for _, value in walk_array(sym_name, array)]
 
+        # Only the non empty buckets are walked
+        f.array_elements = [0] * len(firsts)
+        if np is not None and isinstance(firsts, np.ndarray):
+            buckets = np.flatnonzero(firsts).tolist()
+        else:
+            buckets = [i for i, first in enumerate(firsts) if first != 0]
+
+        bucket_addr = int(array.address)
+        bucket_size = strip_typedefs_fast(array.type).target().sizeof
+        wname = 'CASTED_GLOBAL_HASH_%s' % sym_name
+        for i in buckets:
             # This add the hlist_head
-            f.add_array_element(value.address)
-            self.WORKLIST.append(name, value)
+            f.array_elements[i] = bucket_addr + i * bucket_size
+            self.WORKLIST.append("%s[%d]" % (sym_name, i), array[i])
 
-            while gdb_value_to_int(elem) != 0:
-                pte_struct = custom_container_of(elem, pte_type, offset).dereference()
-                self.WORKLIST.append('CASTED_GLOBAL_HASH_%s' % sym_name, pte_struct)
-                elem = elem["next"]
+            elem = int(firsts[i])
+            while elem != 0 and elem != -1:
+                pte_struct = gdb.Value(elem - offset).cast(pte_type).dereference()
+                self.WORKLIST.append(wname, pte_struct)
+                # next is the first field of hlist_node
+                elem = read_int(elem, 8)
 
         self.GLOBAL_CONTAINERS.add(s)
         logging.debug(s)
 
+    # The first pointers of the buckets of a global hashtable, read with
+    # a single read (an array when numpy is available).
+    def read_hashtable_buckets(self, array, size):
+        bucket_size = strip_typedefs_fast(array.type).target().sizeof
+        b = read_memory(int(array.address), size * bucket_size)
+        if b is None:
+            return None
+
+        # hlist_head and hlist_bl_head are a single pointer
+        if np is not None:
+            firsts = np.frombuffer(b, dtype='<u8')
+            if bucket_size != 8:
+                firsts = firsts[::bucket_size // 8]
+            return firsts
+
+        return [int.from_bytes(b[i:i+8], 'little') for i in range(0, len(b), bucket_size)]
+
     def load_global_hashtables(self):
         logging.debug("Loading global hashtables:\n%s" % GLOBAL_HASHTABLES)
 
         for sym_name, (size, pte_type, pte_field_name, filename)  in GLOBAL_HASHTABLES.items():
+            if not self.is_root(sym_name):
+                continue
             sym = self.load_symbol(sym_name, filename)
             if sym is not None:
                 self.load_global_hashtable(sym, sym_name, size, pte_type, pte_field_name, filename)
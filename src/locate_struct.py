@@ -7,6 +7,8 @@
 # Creation Date: 12-09-2016
 
 import traceback
+import functools
+from collections import deque
 import socket
 import cProfile
 import logging
@@ -16,17 +18,169 @@ import sys
 import os
 
 sys.path.append("./")
-from mytypes import Sample, Struct, Field, Node
+from mytypes import Sample, Struct, Field, Node, resolve_strings
 from explorer import Explorer
 from loader import Loader
+from memory import open_image, GdbMemory, PageCache, PageDiff
+from pagetables import load_page_tables
+from gdbstub import GdbStubMemory
+from layout import get_layout
+from validator import validate_struct, set_verdict_cache, close_verdict_cache
+from verdicts import VerdictCache, kernel_build_id
+from shard import Shard
+from checkpoint import Checkpoint
+from incremental import reuse_sample
+from profiler import Profiler
+import tracing
 from qemu_gdb import *
 from worklist import *
 from utils import *
 
-SNAME = str(SNAME)
+# SNAME can be omitted in a session (see SNAMES below)
+try:
+    SNAME = str(SNAME)
+except NameError:
+    SNAME = None
 KDIR = str(KDIR)
-QEMU_PORT = 2222
-GDB_PORT = 1234
+
+# Overridden by run_explorations.py to run several QEMU+gdb pairs at once.
+try:
+    QEMU_PORT = int(QEMU_PORT)
+except NameError:
+    QEMU_PORT = 2222
+
+try:
+    GDB_PORT = int(GDB_PORT)
+except NameError:
+    GDB_PORT = 1234
+
+# Optional: explore a memory dump (ELF core from dump-guest-memory or a
+# raw physical image plus its kmap) instead of a live QEMU.
+# > gdb -q --batch -ex "py SNAME='sample0'; KDIR='...'; IMAGE='../dumps/sample0'" -x locate_struct.py
+try:
+    IMAGE = str(IMAGE)
+except NameError:
+    IMAGE = None
+
+try:
+    KMAP = str(KMAP)
+except NameError:
+    KMAP = None
+
+# Number of processes exploring the snapshot (requires IMAGE).
+try:
+    WORKERS = int(WORKERS)
+except NameError:
+    WORKERS = 1
+
+# Optional: incremental exploration. The structs found in the previous
+# snapshot PREV_SNAME are reused when their pages are the same in
+# PREV_IMAGE (the memory image of the previous snapshot) and in this one.
+try:
+    PREV_SNAME = str(PREV_SNAME)
+except NameError:
+    PREV_SNAME = None
+
+try:
+    PREV_IMAGE = str(PREV_IMAGE)
+except NameError:
+    PREV_IMAGE = None
+
+try:
+    PREV_KMAP = str(PREV_KMAP)
+except NameError:
+    PREV_KMAP = None
+
+# Continue an interrupted exploration from its last checkpoint.
+try:
+    RESUME = bool(RESUME)
+except NameError:
+    RESUME = False
+
+# Walk the guest page tables to know which kernel pages are mapped
+# (and where), instead of discovering it by trial. They are not used
+# (reads go to the backend) if a few globals read through them differ
+# from the backend, e.g. when phys_base cannot be read.
+try:
+    PAGE_TABLES = bool(PAGE_TABLES)
+except NameError:
+    PAGE_TABLES = True
+
+# Optional: bounded exploration. Only the global symbols in ROOTS are
+# used as roots, and the exploration stops HOPS structs away from them.
+# ALLOW_TYPES/DENY_TYPES restrict the struct types which are explored.
+# Where it stopped is recorded in explorations/<SNAME>.frontier.
+# > gdb -q --batch -ex "py SNAME='sample0'; KDIR='...'; ROOTS=['init_task']; HOPS=3" -x locate_struct.py
+def optional_list(name):
+    try:
+        v = globals()[name]
+    except KeyError:
+        return None
+    if isinstance(v, str):
+        v = [i.strip() for i in v.split(",") if i.strip()]
+    return list(v)
+
+ROOTS = optional_list("ROOTS")
+ALLOW_TYPES = optional_list("ALLOW_TYPES")
+DENY_TYPES = optional_list("DENY_TYPES")
+
+try:
+    HOPS = int(HOPS)
+except NameError:
+    HOPS = None
+
+# Maximum length of the strings read from char pointers.
+try:
+    MAX_STRING = int(MAX_STRING)
+except NameError:
+    MAX_STRING = 4096
+
+# Optional: sqlite database of the verdicts of the struct validation,
+# shared by the explorations of the snapshots of the same kernel (see
+# verdicts.py).
+try:
+    VERDICT_CACHE = str(VERDICT_CACHE)
+except NameError:
+    VERDICT_CACHE = None
+
+# Optional: session mode. The kernel metadata (vmlinux, pointer info,
+# System.map, types and symbols) is loaded once and the snapshots in
+# SNAMES are explored one after the other: from IMAGES/<snapshot> (and
+# its .kmap) when IMAGES is given, otherwise with loadvm on the QEMU of
+# QEMU_PORT. Only the caches of the memory contents are reset in between.
+# > gdb -q --batch -ex "py SNAMES=['sample0', 'sample1']; KDIR='...'" -x locate_struct.py
+SNAMES = optional_list("SNAMES")
+
+try:
+    IMAGES = str(IMAGES)
+except NameError:
+    IMAGES = None
+
+# Optional: the steps of the exploration are recorded in a binary trace,
+# ../logs/<SNAME>.trace, and the text log is kept at INFO level. Render
+# the trace as the DEBUG log with: python tracing.py ../logs/<SNAME>.trace
+try:
+    TRACE = bool(TRACE)
+except NameError:
+    TRACE = True
+
+def log_level():
+    return logging.INFO if TRACE else logging.DEBUG
+
+# Optional: live exploration through the built-in gdbstub client (see
+# gdbstub.py) instead of the gdb remote target. True connects to the
+# QEMU gdbstub on GDB_PORT, 'host:port' to a stub serving the snapshot
+# already loaded (i.e. the stand-in server of gdbstub.py).
+try:
+    GDBSTUB = GDBSTUB
+except NameError:
+    GDBSTUB = None
+
+# Structs read together by the batched backends (GDBSTUB)
+PREFETCH = 256
+
+# Number of 4KiB pages kept in the page cache (256MiB).
+PAGE_CACHE_PAGES = 1 << 16
 
 def fixup_field(s, f):
     # The size of kmem_cache is not the one reported in the DWARF
@@ -34,7 +188,7 @@ def fixup_field(s, f):
     # specified in the definition) but rather nr_node_ids elements
     # (free_kmem_cache_nodes).
     if s.ty == "struct kmem_cache" and f.name == "node":
-        nr_node_ids = int(gdb.parse_and_eval("nr_node_ids"))
+        nr_node_ids = gdb_value_to_int(gdb.parse_and_eval("nr_node_ids"))
         current_size = len(f.array_elements)
         f.ty = f.ty.replace(str(current_size), str(nr_node_ids))
         f.array_elements = f.array_elements[:nr_node_ids]
@@ -53,22 +207,23 @@ def fixup_field(s, f):
         
 def fixup_struct(s):
     if s.ty == "struct task_struct":
-        s.size = int(gdb.parse_and_eval("arch_task_struct_size"))
+        s.size = gdb_value_to_int(gdb.parse_and_eval("arch_task_struct_size"))
 
     if s.ty == "struct thread_struct" or s.ty == "struct fpu":
         s.size -= (int(gdb.parse_and_eval("init_task").type.sizeof) -
-                   int(gdb.parse_and_eval("arch_task_struct_size")))
+                   gdb_value_to_int(gdb.parse_and_eval("arch_task_struct_size")))
         
 def walk_field(worklist, explorer, s, f, struct, field, field_name):
     to_explore = []
     if is_ptr_of_ptr_field(s, f) and f.is_deref():
-        field = cast_ptr_of_ptr(s, f, struct, field)
-        f.value = gdb_value_to_int(field)
-        f.set_ptr_array_of_ptr()
+        array = cast_ptr_of_ptr(s, f, struct, field)
+        if array is not None:
+            field = array
+            f.set_ptr_array_of_ptr()
 
     if f.is_array_of_struct() or f.is_array_of_struct_ptr() or f.is_ptr_array_of_ptr():
         for i, (name, v) in enumerate(walk_array(field_name, field)):
-            if is_struct_pointer(v.type):
+            if type_info(v.type).is_struct_pointer:
                 f.add_array_element(v)
             else:
                 f.add_array_element(v.address)
@@ -82,7 +237,8 @@ def walk_field(worklist, explorer, s, f, struct, field, field_name):
         if f.value == 0:
             return []
 
-        for offset, name, v in explorer.handle_percpu_field(field, field_name):
+        for offset, name, v in explorer.profiled("percpu",
+                                                 explorer.handle_percpu_field(field, field_name)):
             f.add_array_element(v)
             worklist.append(name, v)
             to_explore.append((v, -1))
@@ -101,33 +257,49 @@ def walk_struct(w, worklist, sample, explorer):
         
     fixup_struct(s)    
     
-    valid = is_valid_struct(struct)
-    logging.debug("Walking struct '%s' '%s' (size: %d)... @ 0x%016x (valid: %s) %s" %
-                  (s.ty, s.name, s.size, s.addr, valid, "GLOBAL" if s.global_root else ""))
+    valid = validate_struct(struct)
+    tracing.record(tracing.WALK, int(valid) | int(bool(s.global_root)) << 1,
+                   s.ty, s.name, s.addr, s.size)
 
-    
     if not valid:
-        logging.debug('%s' % struct)
-        return
-
-    for field_name, field in deep_items_anon(struct):  # Loop on the fields of the struct
-        if is_type_size_zero(field.type):
-            logging.warning("Zero size for field: %s %s" % (field.type, field_name))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(gdb_value_to_str(struct))
+        return False
+
+    layout = get_layout(struct.type)
+    buf = read_memory(s.addr, layout.size)
+    if buf is None:
+        tracing.record(tracing.UNREADABLE, addr=s.addr)
+        return False
+
+    # The strings pointed by the fields are read all together at the end
+    strings = []
+    for m in layout.members:  # Loop on the fields of the struct
+        if m.size == 0:
+            logging.warning("Zero size for field: %s %s" % (m.type, m.name))
             continue
 
-        f = s.addField(field_name, field)
+        f = s.addLayoutField(m, buf, strings)
 
-        appended = worklist.append(field_name, field)
-
-        to_explore = [(field, -1)]
-        to_explore += walk_field(worklist, explorer, s, f, struct, field, field_name)
+        # Plain data (ints, strings, non struct pointers) never needs
+        # a gdb.Value.
+        if m.needs_value:
+            field_name = m.name
+            field = m.value_of(struct)
+            appended = worklist.append(field_name, field)
+            to_explore = [(field, -1)]
+            to_explore += walk_field(worklist, explorer, s, f, struct, field, field_name)
+        else:
+            appended = 0
+            to_explore = []
 
         try:
             fixup_field(s, f)
         except gdb.error:
             logging.warning("Exception while fixing '%s' in:\n%s" % (f.name, s))
 
-        logging.debug(f)
+        if tracing.is_enabled():
+            tracing.record_field(f)
 
         if not appended and len(to_explore) == 1:
             continue
@@ -137,7 +309,11 @@ def walk_struct(w, worklist, sample, explorer):
             for name, v in works:
                 worklist.append(name, v)
 
+    resolve_strings(strings)
+    if tracing.is_enabled():
+        tracing.record_strings(s.fields)
     sample.dump_struct(s)
+    return True
 
 
 def explore_global_percpu(explorer, worklist, addr, sym, name):
@@ -152,16 +328,18 @@ def explore_global_percpu(explorer, worklist, addr, sym, name):
         was_ptr = True
 
     s = Struct(addr, sym.type, name, global_container=True)
-    sym_array_ptr = sym.type.array(0, NR_CPUS-1).pointer()
+    sym_array_ptr = sym.type.array(0, len(per_cpu)-1).pointer()
     field_value = gdb.Value(addr).cast(sym_array_ptr).dereference()
     f = s.addField(name, field_value)
-    s.size = 8*(NR_CPUS)
+    s.size = 8*len(per_cpu)
 
-    for offset, name, v in explorer.handle_percpu_field(sym, name):
+    for offset, name, v in explorer.profiled("percpu", explorer.handle_percpu_field(sym, name)):
         worklist.append(name, v)
         if was_ptr:
-            v = v.dereference()
-        f.add_array_element(v, check=False)
+            # The pointer stored in the percpu area of this CPU
+            f.add_array_element(per_cpu.read_pointer(int(v)), check=False)
+        else:
+            f.add_array_element(v, check=False)
         
     return s
     
@@ -175,62 +353,287 @@ def explore_global_percpus(sample, explorer, worklist, global_percpus):
         s = explore_global_percpu(explorer, worklist, addr, sym, name)        
         sample.dump_struct(s)
         logging.debug(s)
-        addr += 8*(NR_CPUS)
+        addr += 8*len(per_cpu)
 
 
-def do_analysis(worklist, sample, explorer):
-    for i, work in enumerate(worklist.worklist):
-        walk_struct(work, worklist, sample, explorer)
+def do_analysis(worklist, sample, explorer, checkpoint=None):
+    profiler = explorer.profiler
+    prefetch = is_memory_batched()
+    for i, work in enumerate(worklist):
+        # The structs coming next are read together
+        if prefetch and i % PREFETCH == 0:
+            prefetch_memory(worklist.peek_ranges(PREFETCH))
+
+        if profiler is not None:
+            begin = profiler.struct_begin()
+            valid = walk_struct(work, worklist, sample, explorer)
+            profiler.struct_end(type_info(work[1].type).named, valid, begin)
+        else:
+            walk_struct(work, worklist, sample, explorer)
+
+        if checkpoint is not None:
+            checkpoint.maybe_save(i, worklist, sample)
 
         if i % 50000 == 0:
-            tot = len(worklist.worklist)
-            sys.stdout.write("processed: %d total: %d left: %d\n" % (i, tot,
-                                                                     tot - i))
+            left = len(worklist)
+            sys.stdout.write("processed: %d total: %d left: %d\n" % (i, i + left,
+                                                                     left))
             sys.stdout.flush()
+            logging.info(type_info_stats())
+            logging.info(worklist.stats())
         
-def explore_sample():
+# Entry point of the worker processes of a sharded exploration.
+def explore_shard(shard, shard_path, worklist, explorer):
+    log_file = "../logs/%s.shard%d" % (SNAME, shard.wid)
+    logging.basicConfig(format='%(levelname)s : %(message)s',
+                        stream=open(log_file, "w"),
+                        level=log_level(), force=True)
+    if TRACE:
+        tracing.open_trace("%s.trace" % log_file)
+
+    sample = Sample(shard_path)
+    if explorer.profiler is not None:
+        explorer.profiler.reset()
+
+    # Global roots are split round robin, everything else by owner.
+    owned = deque()
+    for i, work in enumerate(worklist.worklist):
+        tid, addr, _, global_root, _ = work
+        if global_root:
+            if i % shard.nworkers == shard.wid:
+                owned.append(work)
+        elif shard.is_mine(worklist.named_type(tid), addr):
+            owned.append(work)
+
+    worklist.worklist = owned
+    worklist.shard = shard
+
+    while True:
+        do_analysis(worklist, sample, explorer)
+        if not shard.receive(worklist):
+            break
+
+    logging.info("[+] Shard %d found %d structs" % (shard.wid, sample.counter))
+    shard.counters[shard.wid] = sample.counter
+    sample.close()
+    tracing.close_trace()
+    close_verdict_cache()
+    if explorer.profiler is not None:
+        explorer.profiler.save("%s.profile.json" % shard_path, SNAME)
+
+# With the Loader of the previous snapshot of a session, only the
+# snapshot is loaded again. Returns the Loader.
+def explore_sample(diff=None, profiler=None, L=None):
     exp_result = "../explorations/%s" % (SNAME)
     print("[+] Exploration result in %s" % exp_result)
-    sample = Sample(exp_result)
-    L = Loader(KDIR)
-
+    checkpoint = Checkpoint("%s.checkpoint" % exp_result)
+    # The sample is written in partial and renamed to exp_result at the
+    # end: exp_result only exists when the exploration completed.
+    partial = "%s.part" % exp_result
+    if os.path.exists(exp_result):
+        os.remove(exp_result)
+    if L is None:
+        L = Loader(KDIR, ROOTS)
+    else:
+        L.load_snapshot()
     worklist = L.WORKLIST
-    global_structs_addr = set([gdb_value_to_int(v.address) for (_, v, _) in worklist.worklist])
+    worklist.set_bounds(HOPS, ALLOW_TYPES, DENY_TYPES)
+
+    state = checkpoint.load() if RESUME else None
+    if RESUME and state is None:
+        print("[-] No checkpoint found in %s, starting from scratch" % checkpoint.path)
+
+    if state is not None:
+        sample = Sample(partial, state["sample_offset"], state["sample_counter"])
+        checkpoint.restore(state, worklist)
+        global_structs_addr = checkpoint.global_structs_addr
+        print("[+] Resuming from %s: %d structs dumped, %d pending" %
+              (checkpoint.path, sample.counter, len(worklist)))
+    else:
+        sample = Sample(partial)
+        global_structs_addr = worklist.addresses()
+        checkpoint.global_structs_addr = global_structs_addr
+
     explorer = Explorer(L.NODE_INFO, L.POINTER_INFO, global_structs_addr)
-    global_heads = L.GLOBAL_HEADS
-    global_percpus = L.PERCPU_GLOBALS
+    explorer.profiler = profiler
 
-    for s in L.GLOBAL_CONTAINERS:
-        sample.dump_struct(s)
+    if state is None:
+        if diff is not None:
+            prev_result = "../explorations/%s" % PREV_SNAME
+            reused, dirty = reuse_sample(prev_result, diff, worklist, sample)
+            print("[+] Incremental from %s: %d structs reused, %d to walk again" %
+                  (PREV_SNAME, reused, dirty))
 
-    explore_global_percpus(sample, explorer, worklist, global_percpus)
+        global_heads = L.GLOBAL_HEADS
+        global_percpus = L.PERCPU_GLOBALS
 
-    for i in global_heads:
-        struct_type, field_name = global_heads[i]
-        for name, v in explorer.handle_global_head(i, struct_type, field_name):
-            worklist.append(name, v)
+        for s in L.GLOBAL_CONTAINERS:
+            sample.dump_struct(s)
+
+        explore_global_percpus(sample, explorer, worklist, global_percpus)
+
+        for i in global_heads:
+            if not L.is_root(i):
+                continue
+            struct_type, field_name = global_heads[i]
+            for name, v in explorer.profiled("global_head",
+                                             explorer.handle_global_head(i, struct_type, field_name)):
+                worklist.append(name, v)
 
     print("[+] Ready to start the exploration")
-    do_analysis(worklist, sample, explorer)
+    if WORKERS > 1:
+        # The shards cannot be checkpointed: the work in flight between
+        # the workers is not saved anywhere.
+        print("[+] Sharding the exploration across %d workers" % WORKERS)
+        sample.flush()
+        shard = Shard(WORKERS)
+        shard.start(functools.partial(explore_shard, worklist=worklist, explorer=explorer),
+                    exp_result)
+        sample.counter += shard.merge(sample, exp_result)
+        if profiler is not None:
+            for wid in range(WORKERS):
+                path = "%s.profile.json" % shard.shard_path(exp_result, wid)
+                if os.path.isfile(path):
+                    profiler.merge(path)
+                    os.remove(path)
+    else:
+        checkpoint.save(worklist, sample)
+        do_analysis(worklist, sample, explorer, checkpoint)
+    sample.close()
+    os.replace(partial, exp_result)
+    tracing.close_trace()
+    close_verdict_cache()
+    checkpoint.remove()
     logging.info("[+] We found %d structs" % sample.counter)
-    return
+    print("[+] %s" % worklist.stats())
+    logging.info(worklist.stats())
+
+    if worklist.is_bounded():
+        frontier = "%s.frontier" % exp_result
+        n = worklist.save_frontier(frontier)
+        print("[+] Bounded exploration stopped at %d structs, see %s" % (n, frontier))
+
+    if profiler is not None:
+        profile = "%s.profile.json" % exp_result
+        profiler.save(profile, SNAME)
+        print("[+] Profile in %s" % profile)
+    return L
 
 
 def create_dir(d):
     if not os.path.exists(d):
         os.makedirs(d)
     
+def start_log(sname):
+    log_file = "../logs/%s" % (sname)
+    print("[+] Logging in %s" % log_file)
+    logging.basicConfig(format='%(levelname)s : %(message)s',
+                        stream=open(log_file, "w"),
+                        level=log_level(), force=True)
+    if TRACE:
+        trace_file = "%s.trace" % log_file
+        print("[+] Tracing in %s" % trace_file)
+        tracing.open_trace(trace_file)
+
+# The live backend stays connected across the snapshots of a session
+live_backend = None
+gdb_connected = False
+
+def open_backend():
+    global live_backend, gdb_connected
+
+    if IMAGE is not None:
+        print("[+] Reading memory from %s" % IMAGE)
+        return open_image(IMAGE, KMAP)
+
+    if isinstance(GDBSTUB, str):
+        if live_backend is None:
+            host, port = GDBSTUB.rsplit(":", 1)
+            print("[+] Reading memory from the gdbstub at %s" % GDBSTUB)
+            live_backend = GdbStubMemory(host, int(port))
+        return live_backend
+
+    if live_backend is None:
+        if not GDBSTUB:
+            connect_gdb_remote(GDB_PORT)
+            gdb_connected = True
+        connect_qemu_monitor('localhost', QEMU_PORT)
+
+    send_qemu_monitor(b'stop')
+    send_qemu_monitor('loadvm %s' % SNAME)
+
+    if live_backend is None:
+        if GDBSTUB:
+            print("[+] Reading memory from the gdbstub on port %d" % GDB_PORT)
+            live_backend = GdbStubMemory('localhost', GDB_PORT)
+        else:
+            live_backend = GdbMemory()
+    elif gdb_connected:
+        # The registers gdb read belong to the previous snapshot
+        gdb.execute('maintenance flush register-cache', to_string=True)
+    return live_backend
+
+# Explores the snapshot SNAME, with the Loader of the previous snapshot
+# of a session if any. Returns the Loader.
+def explore_snapshot(L=None):
+    start = time.time()
+    backend = open_backend()
+
+    page_tables = None
+    if PAGE_TABLES:
+        page_tables = load_page_tables(backend)
+    if page_tables is not None:
+        print("[+] %s" % page_tables.stats())
+        backend = page_tables
+
+    page_cache = PageCache(backend, PAGE_CACHE_PAGES)
+    set_memory_backend(page_cache)
+    reset_memory_caches()
+
+    diff = None
+    if PREV_SNAME is not None:
+        print("[+] Diffing against %s" % PREV_IMAGE)
+        prev = open_image(PREV_IMAGE, PREV_KMAP)
+        prev_tables = load_page_tables(prev) if PAGE_TABLES else None
+        diff = PageDiff(prev_tables or prev, page_cache)
+
+    load_percpu_ranges()
+
+    print('\n------ Analyzing %s ------' % SNAME)
+    L = explore_sample(diff, Profiler(page_cache), L)
+    print("Exploration took: %.2fs" % (time.time() - start))
+    print("[+] %s" % page_cache.stats())
+    logging.info(page_cache.stats())
+    logging.info(type_info_stats())
+    if diff is not None:
+        print("[+] %s" % diff.stats())
+    return L
+
+def explore_session():
+    global SNAME, IMAGE, KMAP
+
+    L = None
+    for sname in SNAMES:
+        SNAME = sname
+        if IMAGES is not None:
+            IMAGE = os.path.join(IMAGES, sname)
+            KMAP = IMAGE + ".kmap" if os.path.isfile(IMAGE + ".kmap") else None
+        start_log(sname)
+        L = explore_snapshot(L)
+
 def main():
     print("[+] Target kernel %s" % KDIR)
     
     create_dir("../logs")
     create_dir("../explorations/")
-    
-    log_file = "../logs/%s" % (SNAME)
-    print("[+] Logging in %s" % log_file)
-    logging.basicConfig(format='%(levelname)s : %(message)s',
-                        stream=open(log_file, "w"),
-                        level=logging.DEBUG)
+
+    if SNAMES is None and SNAME is None:
+        print("[-] Either SNAME or SNAMES is needed")
+        return
+
+    # In a session every snapshot has its own log
+    if SNAMES is None:
+        start_log(SNAME)
 
     logging.debug("gdb_port = %d qemu_port = %d" % (GDB_PORT, QEMU_PORT))
 
@@ -238,27 +641,52 @@ def main():
     gdb.execute('set architecture i386:x86-64', to_string=True)
     gdb.execute('set max-value-size unlimited', to_string=True)
     gdb.execute('maint set symbol-cache-size 4096')
-    connect_gdb_remote(GDB_PORT)
 
-    connect_qemu_monitor('localhost', QEMU_PORT)
-    send_qemu_monitor(b'stop')
-    send_qemu_monitor('loadvm %s' % SNAME)
+    if WORKERS > 1 and IMAGE is None and IMAGES is None:
+        print("[-] A sharded exploration (WORKERS > 1) needs a memory IMAGE")
+        return
+
+    if WORKERS > 1 and (ROOTS is not None or HOPS is not None):
+        print("[-] A bounded exploration (ROOTS, HOPS) cannot be sharded")
+        return
+
+    if PREV_SNAME is not None and PREV_IMAGE is None:
+        print("[-] An incremental exploration (PREV_SNAME) needs the PREV_IMAGE")
+        return
 
+    if PREV_SNAME is not None and SNAMES is not None:
+        print("[-] An incremental exploration (PREV_SNAME) cannot be a session (SNAMES)")
+        return
+
+    set_max_c_string(MAX_STRING)
     load_executable_sections(KDIR)
 
-    print('\n------ Analyzing %s ------' % SNAME)
-    start = time.time()
-    explore_sample()
-    print("Exploration took: %.2fs" % (time.time() - start))
+    if VERDICT_CACHE is not None:
+        set_verdict_cache(VerdictCache(VERDICT_CACHE, kernel_build_id(KDIR)))
+
+    if SNAMES is None:
+        explore_snapshot()
+    else:
+        explore_session()
+
+    disconnect()
 
-    gdb.execute('disconnect')
+def disconnect():
+    if gdb_connected:
+        gdb.execute('disconnect')
 
 if __name__ == "__main__":
     try:
         main()
     except Exception as err:
         print(traceback.print_exc())
-        gdb.execute('disconnect')
+        try:
+            disconnect()
+        except gdb.error:
+            pass
+        # gdb --batch exits with 0 otherwise: run_explorations.py would
+        # take the partial sample for a complete one
+        gdb.execute("quit 1")
 
 
     # cProfile.run('main()', filename="/tmp/prof%d" % SID, sort=1)
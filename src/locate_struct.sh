@@ -1,11 +1,11 @@
 name="server"
-count=`ls ../dumps/$name/* | grep -v ".kmap" | wc -l`
+snapshots=`ls ../dumps/$name/ | grep -v ".kmap"`
+count=`echo $snapshots | wc -w`
 echo "Starting to locate structs for "$count" samples"
-count=$((count-1))
 mkdir -p ../logs/$name
 mkdir -p ../experiments/$name
 
-seq 0 $count | parallel -j 4 --workdir $PWD "echo AA {}; gdb --batch -q -ex \"py SNAME='$name'; SID={}; KDIR='../clang-kernel/clang-kernel-build/kernel-ubuntu2/linux-hwe-4.8.0/'\"  -x ./locate_struct.py;"
+python3 run_explorations.py -j 4 --kdir '../clang-kernel/clang-kernel-build/kernel-ubuntu2/linux-hwe-4.8.0/' --images ../dumps/$name/ $snapshots
 
 # #Iterative way
 # for i in `seq 0 $count`; do
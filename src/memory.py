@@ -0,0 +1,364 @@
+try:
+    import gdb
+except:
+    pass
+
+import mmap
+import bisect
+import logging
+from collections import OrderedDict
+from elftools.elf.elffile import ELFFile
+
+PAGE_SIZE = 0x1000
+PAGE_MASK = ~(PAGE_SIZE - 1)
+
+# x86_64 layout for the kernels we support (RANDOMIZE_BASE=n, see
+# make_kernel.sh): the direct mapping of all physical memory and the
+# kernel text mapping.
+PAGE_OFFSET = 0xffff880000000000
+DIRECT_MAP_END = 0xffffc7ffffffffff
+START_KERNEL_MAP = 0xffffffff80000000
+
+class Memory:
+
+    # True when is_mapped does not need to read memory
+    fast_is_mapped = False
+
+    # True when reading many pages at once is cheaper than one by one
+    batched = False
+
+    def read(self, addr, size):
+        raise NotImplementedError
+
+    # Physical memory is reachable through the direct mapping
+    def read_physical(self, paddr, size):
+        return self.read(PAGE_OFFSET + paddr, size)
+
+    # {page: bytes or None}
+    def read_pages(self, pages):
+        return {p: self.read(p, PAGE_SIZE) for p in pages}
+
+    def read_physical_pages(self, paddrs):
+        return {p: self.read_physical(p, PAGE_SIZE) for p in paddrs}
+
+    def is_mapped(self, addr):
+        return self.read(addr, 1) is not None
+
+    def is_mapped_range(self, addr, size):
+        page = addr & PAGE_MASK
+        while page < addr + size:
+            if not self.is_mapped(page):
+                return False
+            page += PAGE_SIZE
+        return True
+
+
+# Reads through the gdb remote protocol (QEMU gdbstub).
+class GdbMemory(Memory):
+
+    def read(self, addr, size):
+        try:
+            return gdb.selected_inferior().read_memory(addr, size).tobytes()
+        except gdb.MemoryError:
+            return None
+
+
+# Read-through cache of whole pages on top of another Memory. Pages
+# which cannot be read are cached as well (as None), so a failed read
+# is never repeated. The least recently used pages are evicted once
+# max_pages is reached.
+class PageCache(Memory):
+
+    def __init__(self, backend, max_pages=65536):
+        self.backend = backend
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def batched(self):
+        return self.backend.batched
+
+    def get_page(self, page):
+        try:
+            b = self.pages[page]
+            self.pages.move_to_end(page)
+            self.hits += 1
+            return b
+        except KeyError:
+            pass
+
+        self.misses += 1
+        b = self.backend.read(page, PAGE_SIZE)
+        self.pages[page] = b
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return b
+
+    # Reads the missing pages of the ranges [(addr, size)] with a single
+    # request to the backend. Prefetched pages count as a miss when
+    # they are read and as a hit when they are used.
+    def prefetch(self, ranges):
+        if not self.backend.batched:
+            return
+
+        missing = set()
+        for addr, size in ranges:
+            page = addr & PAGE_MASK
+            while page < addr + size:
+                if page not in self.pages:
+                    missing.add(page)
+                page += PAGE_SIZE
+        if not missing:
+            return
+
+        self.misses += len(missing)
+        for page, b in self.backend.read_pages(sorted(missing)).items():
+            self.pages[page] = b
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    def read(self, addr, size):
+        page = addr & PAGE_MASK
+        offset = addr - page
+        if offset + size > PAGE_SIZE:
+            self.prefetch([(addr, size)])
+
+        b = self.get_page(page)
+        if b is None:
+            return None
+
+        if offset + size <= PAGE_SIZE:
+            return b[offset:offset+size]
+
+        chunks = [b[offset:]]
+        size -= PAGE_SIZE - offset
+        while size > 0:
+            page += PAGE_SIZE
+            b = self.get_page(page)
+            if b is None:
+                return None
+            chunks.append(b[:size])
+            size -= PAGE_SIZE
+        return b''.join(chunks)
+
+    def is_mapped(self, addr):
+        if self.backend.fast_is_mapped:
+            return self.backend.is_mapped(addr)
+        return self.get_page(addr & PAGE_MASK) is not None
+
+    def is_mapped_range(self, addr, size):
+        if self.backend.fast_is_mapped:
+            return self.backend.is_mapped_range(addr, size)
+        return Memory.is_mapped_range(self, addr, size)
+
+    def clear(self):
+        self.pages.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = (100.0 * self.hits / total) if total else 0
+        return ("Page cache: %d pages cached, %d hits, %d misses (hit rate %.2f%%)" %
+                (len(self.pages), self.hits, self.misses, ratio))
+
+
+# A MemoryImage serves the reads of the exploration from a dump on
+# disk instead of the gdbstub. Addresses are kernel virtual addresses
+# and are translated locally to an offset inside the mmap'd file.
+#
+# virtual_ranges and physical_ranges are sorted lists of
+# (start, end, file_offset).
+class MemoryImage(Memory):
+
+    fast_is_mapped = True
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.virtual_ranges = []
+        self.physical_ranges = []
+        self.virtual_starts = []
+        self.physical_starts = []
+
+    def sort_ranges(self):
+        self.virtual_ranges.sort()
+        self.physical_ranges.sort()
+        self.virtual_starts = [s for (s, _, _) in self.virtual_ranges]
+        self.physical_starts = [s for (s, _, _) in self.physical_ranges]
+
+    @staticmethod
+    def lookup_range(starts, ranges, addr):
+        i = bisect.bisect_right(starts, addr) - 1
+        if i < 0:
+            return None
+        start, end, offset = ranges[i]
+        if addr >= end:
+            return None
+        return start, end, offset
+
+    def physical_to_offset(self, paddr):
+        r = self.lookup_range(self.physical_starts, self.physical_ranges, paddr)
+        if r is None:
+            return None, 0
+        start, end, offset = r
+        return offset + (paddr - start), end - paddr
+
+    def virtual_to_physical(self, addr):
+        if PAGE_OFFSET <= addr <= DIRECT_MAP_END:
+            return addr - PAGE_OFFSET
+        if addr >= START_KERNEL_MAP:
+            return addr - START_KERNEL_MAP
+        return None
+
+    # Returns the file offset of addr and how many bytes can be read
+    # contiguously from there.
+    def translate(self, addr):
+        r = self.lookup_range(self.virtual_starts, self.virtual_ranges, addr)
+        if r is not None:
+            start, end, offset = r
+            return offset + (addr - start), end - addr
+
+        paddr = self.virtual_to_physical(addr)
+        if paddr is None:
+            return None, 0
+
+        offset, avail = self.physical_to_offset(paddr)
+        # The linear translations are only valid up to the end of the page.
+        return offset, min(avail, PAGE_SIZE - (addr & ~PAGE_MASK))
+
+    def is_mapped(self, addr):
+        return self.translate(addr)[0] is not None
+
+    def read(self, addr, size):
+        chunks = []
+        while size > 0:
+            offset, avail = self.translate(addr)
+            if offset is None:
+                return None
+            n = min(size, avail)
+            chunks.append(self.mm[offset:offset+n])
+            addr += n
+            size -= n
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def read_physical(self, paddr, size):
+        offset, avail = self.physical_to_offset(paddr)
+        if offset is None or avail < size:
+            return None
+        return self.mm[offset:offset+size]
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+
+# ELF core created with the QEMU monitor command `dump-guest-memory`.
+# When the dump was taken with paging (-p, see take_snapshots.sh) the
+# PT_LOAD segments carry the guest virtual addresses, otherwise only
+# the physical ones and we fall back to the linear kernel mappings.
+class ElfCoreImage(MemoryImage):
+
+    def __init__(self, path):
+        MemoryImage.__init__(self, path)
+
+        elffile = ELFFile(self.f)
+        for segment in elffile.iter_segments():
+            if segment['p_type'] != 'PT_LOAD':
+                continue
+
+            offset = segment['p_offset']
+            size = segment['p_filesz']
+            vaddr = segment['p_vaddr']
+            paddr = segment['p_paddr']
+
+            if vaddr != 0:
+                self.virtual_ranges.append((vaddr, vaddr+size, offset))
+            self.physical_ranges.append((paddr, paddr+size, offset))
+
+        self.sort_ranges()
+        logging.info("[+] Loaded ELF core %s: %d virtual and %d physical ranges" %
+                     (path, len(self.virtual_ranges), len(self.physical_ranges)))
+
+
+# Raw physical memory image, with the virtual to physical kernel
+# mappings extracted by the linux_dump_kmap volatility plugin.
+class RawImage(MemoryImage):
+
+    def __init__(self, path, kmap_path=None):
+        MemoryImage.__init__(self, path)
+        self.physical_ranges.append((0, len(self.mm), 0))
+        self.sort_ranges()
+
+        self.kmap = dict()
+        if kmap_path is not None:
+            self.load_kmap(kmap_path)
+
+        logging.info("[+] Loaded raw image %s (%d kmap entries)" % (path, len(self.kmap)))
+
+    def load_kmap(self, kmap_path):
+        with open(kmap_path, 'r') as f:
+            for l in f:
+                if l.startswith("0x"):
+                    vaddr, paddr = l.strip().split()
+                    self.kmap[int(vaddr, 16)] = int(paddr, 16)
+
+    def virtual_to_physical(self, addr):
+        try:
+            return self.kmap[addr & PAGE_MASK] + (addr & ~PAGE_MASK)
+        except KeyError:
+            pass
+
+        try:
+            return self.kmap[addr & ~0x1fffff] + (addr & 0x1fffff)
+        except KeyError:
+            pass
+
+        return MemoryImage.virtual_to_physical(self, addr)
+
+
+# Pages which differ between two snapshots of the same machine,
+# compared lazily and only once. A page which cannot be read in the new
+# snapshot is always dirty.
+class PageDiff:
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.dirty = dict()
+
+    def is_dirty(self, page):
+        try:
+            return self.dirty[page]
+        except KeyError:
+            pass
+
+        b = self.new.read(page, PAGE_SIZE)
+        d = b is None or b != self.old.read(page, PAGE_SIZE)
+        self.dirty[page] = d
+        return d
+
+    def is_dirty_range(self, addr, size):
+        page = addr & PAGE_MASK
+        while page < addr + max(size, 1):
+            if self.is_dirty(page):
+                return True
+            page += PAGE_SIZE
+        return False
+
+    def stats(self):
+        ndirty = sum(1 for d in self.dirty.values() if d)
+        return "Page diff: %d pages compared, %d dirty" % (len(self.dirty), ndirty)
+
+
+def open_image(path, kmap_path=None):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+
+    if magic == b'\x7fELF':
+        return ElfCoreImage(path)
+    return RawImage(path, kmap_path)
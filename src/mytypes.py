@@ -2,6 +2,8 @@ from utils import *
 import logging
 from enum import Enum, IntEnum
 import pickle
+import queue
+import threading
 
 # TODO: to handle PTR_ARRAY_OF_PTR we should create a Struct containing an array field.
 
@@ -105,6 +107,48 @@ class Field:
         if debug:
             logging.debug("Creating %s" % self)
 
+    # Same as __init__, but decoded from the raw bytes of the struct
+    # using a precompiled layout Member (see layout.py).
+    @staticmethod
+    def from_member(m, struct_addr, buf, strings=None):
+        self = Field.__new__(Field)
+        value = m.decode(buf) if m.is_scalar else 0
+
+        self.attr = m.get_attr(value)
+        self.addr = struct_addr + m.offset
+        self.ty = m.ty
+        self.name = m.name
+        self.array_elements = []
+        self.s = ""
+        self.pte_type = m.pte_type
+        self.size = m.size
+
+        # With strings, the strings pointed by the field are not read
+        # here but collected and read later by resolve_strings.
+        if (self.is_array_of_char_ptr()):
+            self.array_elements = m.decode_array(buf)
+            if strings is None:
+                self.s = [decode_c_string(read_c_string(e)) for e in self.array_elements]
+            else:
+                self.s = [""] * len(self.array_elements)
+                strings += [(self, i, e) for (i, e) in enumerate(self.array_elements) if e]
+
+        elif self.is_char_ptr():
+            if strings is None:
+                self.s = decode_c_string(read_c_string(value))
+            elif value:
+                strings.append((self, None, value))
+
+        elif self.is_array_of_char():
+            self.s = decode_c_string(buf[m.offset:m.offset+m.size])
+
+        if (self.is_ptr() or m.is_int):
+            self.value = value
+        else:
+            self.value = ""
+
+        return self
+
     def __repr__(self):
         r = "Field : [{}] 0x{:016x} {} {} ".format(self.attr.name, self.addr, self.ty, self.name)
         if self.is_ptr_array_of_ptr() or self.is_percpu():
@@ -126,56 +170,58 @@ class Field:
 
     @staticmethod
     def get_field_attr(t, v):
-        if is_array_of_struct(t):
+        ti = type_info(t)
+
+        if ti.is_array_of_struct:
             return FieldAttr.ARRAY_OF_STRUCT
 
-        if is_array_of_struct_pointer(t):
+        if ti.is_array_of_struct_pointer:
             return FieldAttr.ARRAY_OF_STRUCT_PTR
 
-        if is_array_of_char(t):
+        if ti.is_array_of_char:
             return FieldAttr.ARRAY_OF_CHAR
 
-        if is_array_of_char_pointer(t):
+        if ti.is_array_of_char_pointer:
             return FieldAttr.ARRAY_OF_CHAR_PTR
 
-        if is_struct(t):
+        if ti.is_struct:
             return FieldAttr.STRUCT
 
-        if is_function_pointer(t):
+        if ti.is_function_pointer:
             is_deref = is_dereferenceable(v)
             if is_deref:
                 return FieldAttr.FUNC_PTR
             else:
                 return FieldAttr.FUNC_PTR_NODEREF
 
-        if is_pointer_of_pointer(t):
+        if ti.is_pointer_of_pointer:
             is_deref = is_dereferenceable(v)
             if is_deref:
                 return FieldAttr.PTR_OF_PTR
             else:
                 return FieldAttr.PTR_OF_PTR_NODEREF
 
-        if is_struct_pointer(t):
+        if ti.is_struct_pointer:
             is_deref = is_dereferenceable(v)
             if is_deref:
                 return FieldAttr.STRUCT_PTR
             else:
                 return FieldAttr.STRUCT_PTR_NODEREF
 
-        if is_void_pointer(t):
+        if ti.is_void_pointer:
             if is_dereferenceable_void(v):
                 return FieldAttr.VOID_PTR
             else:
                 return FieldAttr.VOID_PTR_NODEREF
 
-        if is_char_pointer(t):
+        if ti.is_char_pointer:
             is_deref = is_dereferenceable(v)
             if is_deref:
                 return FieldAttr.CHAR_PTR
             else:
                 return FieldAttr.CHAR_PTR_NODEREF
 
-        if is_pointer(t):
+        if ti.is_pointer:
             is_deref = is_dereferenceable(v)
             if is_deref:
                 return FieldAttr.PTR
@@ -190,7 +236,7 @@ class Field:
         else:
             self.attr = FieldAttr.STRUCT_PTR_PERCPU
 
-    def set_ptr_array_of_ptr(self, value):
+    def set_ptr_array_of_ptr(self):
         self.attr = FieldAttr.PTR_ARRAY_OF_PTR
 
     def is_ptr_array_of_ptr(self):
@@ -273,6 +319,20 @@ class Field:
         return self.is_other() and type(self.value) == int and self.value > 0xffff800000000000
 
 
+# Fills in the strings collected by Field.from_member, reading all of
+# them at once.
+def resolve_strings(strings):
+    if not strings:
+        return
+
+    values = read_c_strings([addr for (_, _, addr) in strings])
+    for (f, i, addr) in strings:
+        if i is None:
+            f.s = decode_c_string(values[addr])
+        else:
+            f.s[i] = decode_c_string(values[addr])
+
+
 class Struct:
 
     def __init__(self, addr, ty, name, global_root=False, global_container=False):
@@ -294,6 +354,11 @@ class Struct:
         self.fields.append(f)
         return f
 
+    def addLayoutField(self, member, buf, strings=None):
+        f = Field.from_member(member, self.addr, buf, strings)
+        self.fields.append(f)
+        return f
+
     def is_global_root(self):
         return self.global_root
 
@@ -341,15 +406,99 @@ class Struct:
             yield i
 
 
+# Structs handed to the writer thread and not yet written
+SAMPLE_QUEUE_SIZE = 4096
+SAMPLE_BUFFER_SIZE = 1 << 20
+
 class Sample:
-    def __init__(self, path):
-        self.sample_file = open(path, 'wb+')
-        self.counter = 0
+    # With offset, an existing sample is reopened and truncated there
+    # (resume from a checkpoint).
+    #
+    # The structs are serialized by a writer thread: dump_struct only
+    # queues them, flush waits until everything queued is written.
+    def __init__(self, path, offset=None, counter=0):
+        if offset is None:
+            self.sample_file = open(path, 'wb+', buffering=SAMPLE_BUFFER_SIZE)
+        else:
+            self.sample_file = open(path, 'rb+', buffering=SAMPLE_BUFFER_SIZE)
+            self.sample_file.truncate(offset)
+            self.sample_file.seek(offset)
+        self.counter = counter
+        # First exception of the writer thread, raised again by flush
+        # and close: the sample is incomplete from there on.
+        self.error = None
+
+        self.queue = queue.Queue(SAMPLE_QUEUE_SIZE)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
 
     def dump_struct(self, struct):
-        pickle.dump(struct, self.sample_file)
+        self.check_error()
+        self.queue.put(struct)
         self.counter += 1
 
+    # Copies a struct pickled by another Sample (see iter_raw).
+    def dump_raw(self, raw):
+        self.check_error()
+        self.queue.put(raw)
+        self.counter += 1
+
+    def write_loop(self):
+        # The memo is cleared after every struct, so that each one can
+        # be loaded on its own (see load and iter_raw).
+        pickler = pickle.Pickler(self.sample_file)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < SAMPLE_QUEUE_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for item in batch:
+                try:
+                    if item is None:
+                        stop = True
+                    elif self.error is not None:
+                        continue
+                    elif isinstance(item, bytes):
+                        self.sample_file.write(item)
+                    else:
+                        pickler.dump(item)
+                        pickler.clear_memo()
+                except Exception as e:
+                    logging.error("Cannot write %s: %s" % (item, e))
+                    self.error = e
+                finally:
+                    self.queue.task_done()
+
+            if stop:
+                return
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        if self.writer.is_alive():
+            self.queue.join()
+        self.check_error()
+        self.sample_file.flush()
+
+    def tell(self):
+        self.flush()
+        return self.sample_file.tell()
+
+    def close(self):
+        if self.sample_file.closed:
+            return
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.sample_file.close()
+        self.check_error()
+
     @staticmethod
     def load(path):
         structs = set()
@@ -362,5 +511,21 @@ class Sample:
                 break
         return structs
 
+    # Yields every struct of a sample together with its pickled bytes,
+    # without keeping the whole sample in memory.
+    @staticmethod
+    def iter_raw(path):
+        with open(path, "rb") as f:
+            while True:
+                start = f.tell()
+                try:
+                    s = pickle.load(f, encoding='utf-8')
+                except EOFError:
+                    break
+                end = f.tell()
+                f.seek(start)
+                raw = f.read(end - start)
+                yield s, raw
+
     def __del__(self):
-        self.sample_file.close()
+        self.close()
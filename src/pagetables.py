@@ -0,0 +1,228 @@
+try:
+    import gdb
+except:
+    pass
+
+import bisect
+import struct
+import logging
+from memory import Memory, PAGE_SIZE, PAGE_OFFSET, START_KERNEL_MAP
+
+# Kernel virtual memory as mapped by the guest page tables. The kernel
+# half of the PGD (init_mm.pgd, or CR3) is walked once at startup and
+# every mapped page is recorded in a sorted list of ranges, with the
+# physical address they map to. Afterwards, knowing if an address is
+# mapped is a bisect and reads go straight to the physical memory: no
+# failed read is ever sent to the backend.
+
+PRESENT = 1 << 0
+PSE = 1 << 7
+PHYS_MASK = 0x000ffffffffff000
+
+ENTRIES = struct.Struct('<512Q')
+
+# Page size mapped by an entry at each level (PGD, PUD, PMD, PTE)
+LEVEL_SIZES = [1 << 39, 1 << 30, 1 << 21, 1 << 12]
+
+def canonical(addr):
+    if addr & (1 << 47):
+        return addr | 0xffff000000000000
+    return addr
+
+class PageTableMap(Memory):
+
+    fast_is_mapped = True
+
+    def __init__(self, backend, pgd):
+        self.backend = backend
+        self.pgd = pgd
+        self.tables = 0
+
+        # (start, end, paddr) with end excluded
+        self.ranges = []
+        self.walk(pgd, 0, 0)
+        self.starts = [s for (s, _, _) in self.ranges]
+
+    def add(self, vaddr, size, paddr):
+        if self.ranges:
+            s, e, p = self.ranges[-1]
+            if e == vaddr and p + (e - s) == paddr:
+                self.ranges[-1] = (s, vaddr + size, p)
+                return
+        self.ranges.append((vaddr, vaddr + size, paddr))
+
+    def walk(self, table, level, base):
+        b = self.backend.read_physical(table, PAGE_SIZE)
+        if b is None:
+            logging.debug("Cannot read page table @ 0x%x" % table)
+            return
+        self.tables += 1
+
+        size = LEVEL_SIZES[level]
+        # Only the kernel half of the address space
+        first = 256 if level == 0 else 0
+
+        entries = ENTRIES.unpack(b)
+        for i in range(first, 512):
+            e = entries[i]
+            if not e & PRESENT:
+                continue
+
+            vaddr = canonical(base + i * size)
+            paddr = e & PHYS_MASK
+            if level == 3 or (level in (1, 2) and e & PSE):
+                # Large pages: the low bits of the address are flags
+                self.add(vaddr, size, paddr & ~(size - 1))
+            else:
+                self.walk(paddr, level + 1, base + i * size)
+
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        start, end, paddr = self.ranges[i]
+        if addr >= end:
+            return None
+        return start, end, paddr
+
+    def translate(self, addr):
+        r = self.lookup(addr)
+        if r is None:
+            return None
+        start, _, paddr = r
+        return paddr + (addr - start)
+
+    def is_mapped(self, addr):
+        return self.lookup(addr) is not None
+
+    def is_mapped_range(self, addr, size):
+        end = addr + size
+        while addr < end:
+            r = self.lookup(addr)
+            if r is None:
+                return False
+            addr = r[1]
+        return True
+
+    def read(self, addr, size):
+        chunks = []
+        while size > 0:
+            r = self.lookup(addr)
+            if r is None:
+                return None
+            start, end, paddr = r
+            # Physically contiguous only up to the end of the page
+            n = min(size, end - addr, PAGE_SIZE - (addr & (PAGE_SIZE - 1)))
+            b = self.backend.read_physical(paddr + (addr - start), n)
+            if b is None:
+                return None
+            chunks.append(b)
+            addr += n
+            size -= n
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def read_physical(self, paddr, size):
+        return self.backend.read_physical(paddr, size)
+
+    @property
+    def batched(self):
+        return self.backend.batched
+
+    def read_pages(self, pages):
+        paddrs = {}
+        for page in pages:
+            r = self.lookup(page)
+            paddrs[page] = None if r is None else r[2] + (page - r[0])
+
+        b = self.backend.read_physical_pages([p for p in paddrs.values() if p is not None])
+        return {page: None if p is None else b[p] for page, p in paddrs.items()}
+
+    def stats(self):
+        mapped = sum(e - s for (s, e, _) in self.ranges)
+        return ("Page tables: %d tables walked, %d ranges, %d MiB mapped" %
+                (self.tables, len(self.ranges), mapped >> 20))
+
+
+# Physical address the kernel image was loaded at: the kernel text
+# mapping (START_KERNEL_MAP) maps to phys_base, which is not 0 when the
+# kernel is relocated.
+def find_phys_base(backend):
+    try:
+        addr = int(gdb.lookup_global_symbol("phys_base").value().address)
+    except (gdb.error, AttributeError):
+        return 0
+    b = backend.read(addr, 8)
+    if b is None:
+        return None
+    return struct.unpack('<Q', b)[0]
+
+# Physical address of the kernel PGD: init_mm.pgd, or CR3 when the
+# symbol is not available.
+def find_pgd(backend, phys_base):
+    try:
+        init_mm = gdb.lookup_global_symbol("init_mm").value()
+        pgd_field = [f for f in init_mm.type.fields() if f.name == "pgd"][0]
+        b = backend.read(int(init_mm.address) + pgd_field.bitpos // 8, 8)
+        if b is not None:
+            pgd = struct.unpack('<Q', b)[0]
+            if pgd >= START_KERNEL_MAP:
+                return pgd - START_KERNEL_MAP + phys_base
+            if pgd >= PAGE_OFFSET:
+                return pgd - PAGE_OFFSET
+    except (gdb.error, AttributeError, IndexError):
+        pass
+
+    try:
+        return int(gdb.parse_and_eval("$cr3")) & PHYS_MASK
+    except gdb.error:
+        return None
+
+# Globals read through the page tables and through the backend: if they
+# differ, the page tables (or the PGD found) are not the ones the kernel
+# uses.
+CHECK_SYMBOLS = ["linux_banner", "init_mm"]
+CHECK_SIZE = 64
+
+def check_page_tables(page_tables, backend):
+    checked = 0
+    for name in CHECK_SYMBOLS:
+        try:
+            addr = int(gdb.lookup_global_symbol(name).value().address)
+        except (gdb.error, AttributeError):
+            continue
+        expected = backend.read(addr, CHECK_SIZE)
+        if expected is None:
+            continue
+        if page_tables.read(addr, CHECK_SIZE) != expected:
+            logging.warning("%s @ 0x%x differs through the page tables" % (name, addr))
+            return False
+        checked += 1
+    return checked > 0
+
+def load_page_tables(backend):
+    phys_base = find_phys_base(backend)
+    if phys_base is None:
+        logging.warning("Cannot read phys_base")
+        return None
+
+    pgd = find_pgd(backend, phys_base)
+    if pgd is None:
+        logging.warning("Cannot find the kernel page tables")
+        return None
+
+    page_tables = PageTableMap(backend, pgd)
+    if not page_tables.ranges:
+        logging.warning("No kernel mapping found in the page tables @ 0x%x" % pgd)
+        return None
+
+    # Reads fall back to the backend alone
+    if not check_page_tables(page_tables, backend):
+        logging.warning("Page tables @ 0x%x (phys_base 0x%x) do not match the memory, not using them" %
+                        (pgd, phys_base))
+        return None
+
+    logging.info("[+] %s" % page_tables.stats())
+    return page_tables
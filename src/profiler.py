@@ -0,0 +1,129 @@
+import time
+import json
+
+# Cost of the exploration broken down by struct type and by Explorer
+# handler: number of structs (or handler calls), cumulative time and
+# memory reads. Reads are counted on the page cache: page_reads are all
+# the pages accessed, backend_reads the ones which missed the cache and
+# went to the image or to the gdbstub.
+#
+# Times are cumulative: the time of a struct includes the time of the
+# handlers called while walking it.
+
+class Counters:
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.page_reads = 0
+        self.backend_reads = 0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def merge(self, d):
+        for k, v in d.items():
+            setattr(self, k, getattr(self, k, 0) + v)
+
+
+class TypeCounters(Counters):
+
+    def __init__(self):
+        Counters.__init__(self)
+        self.invalid = 0
+
+
+class HandlerCounters(Counters):
+
+    def __init__(self):
+        Counters.__init__(self)
+        self.works = 0
+
+
+class Profiler:
+
+    def __init__(self, page_cache):
+        self.page_cache = page_cache
+        self.types = dict()
+        self.handlers = dict()
+        self.start = time.time()
+
+    # Forked shard workers start from zero, their reports are merged.
+    def reset(self):
+        self.types = dict()
+        self.handlers = dict()
+
+    def reads(self):
+        return self.page_cache.hits + self.page_cache.misses, self.page_cache.misses
+
+    def struct_begin(self):
+        return time.perf_counter(), self.reads()
+
+    def struct_end(self, ty, valid, begin):
+        t0, (pages0, backend0) = begin
+        pages, backend = self.reads()
+        try:
+            c = self.types[ty]
+        except KeyError:
+            c = self.types[ty] = TypeCounters()
+
+        c.count += 1
+        c.time += time.perf_counter() - t0
+        c.page_reads += pages - pages0
+        c.backend_reads += backend - backend0
+        if not valid:
+            c.invalid += 1
+
+    # Handlers are generators: only the time spent producing the works
+    # is counted, not the time spent by the caller consuming them.
+    def handler(self, kind, works):
+        try:
+            c = self.handlers[kind]
+        except KeyError:
+            c = self.handlers[kind] = HandlerCounters()
+        c.count += 1
+
+        it = iter(works)
+        while True:
+            t0 = time.perf_counter()
+            pages0, backend0 = self.reads()
+            try:
+                w = next(it)
+            except StopIteration:
+                w = None
+                done = True
+            else:
+                done = False
+
+            pages, backend = self.reads()
+            c.time += time.perf_counter() - t0
+            c.page_reads += pages - pages0
+            c.backend_reads += backend - backend0
+            if done:
+                return
+            c.works += 1
+            yield w
+
+    def to_dict(self, sname):
+        def sort(d):
+            return dict(sorted(((k, v.to_dict()) for k, v in d.items()),
+                               key=lambda x: x[1]["time"], reverse=True))
+
+        return {"snapshot": sname,
+                "total_time": time.time() - self.start,
+                "structs": sort(self.types),
+                "handlers": sort(self.handlers)}
+
+    def save(self, path, sname):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(sname), f, indent=1)
+
+    # Adds the counters of another report (e.g. of a shard worker).
+    def merge(self, path):
+        with open(path) as f:
+            report = json.load(f)
+
+        for ty, d in report["structs"].items():
+            self.types.setdefault(ty, TypeCounters()).merge(d)
+        for kind, d in report["handlers"].items():
+            self.handlers.setdefault(kind, HandlerCounters()).merge(d)
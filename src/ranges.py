@@ -0,0 +1,138 @@
+import bisect
+from enum import IntEnum
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from memory import PAGE_OFFSET, DIRECT_MAP_END, START_KERNEL_MAP
+
+# Regions of the x86_64 kernel address space (4.14, 4-level paging,
+# see Documentation/x86/x86_64/mm.txt). The text sections and the
+# percpu chunks are added at runtime, once vmlinux and the snapshot are
+# loaded.
+VMALLOC_START = 0xffffc90000000000
+VMALLOC_END = 0xffffe8ffffffffff
+VMEMMAP_START = 0xffffea0000000000
+VMEMMAP_END = 0xffffeaffffffffff
+KERNEL_MAP_END = 0xffffffff9fffffff
+MODULES_START = 0xffffffffa0000000
+MODULES_END = 0xfffffffffeffffff
+USER_END = 0x7fffffffffff
+
+class Region(IntEnum):
+    NONE = 0
+    USER = 1
+    DIRECT_MAP = 2
+    VMALLOC = 3
+    VMEMMAP = 4
+    KERNEL = 5
+    MODULE = 6
+    PERCPU = 7
+    TEXT = 8
+
+# Sorted, disjoint intervals of the address space, each one with its
+# Region. Ranges can be added in any order and can overlap: where they
+# do, the Region added with the highest priority wins (i.e. a text
+# section inside the kernel mapping, a percpu chunk inside the direct
+# map).
+class AddressIndex:
+
+    def __init__(self):
+        # (start, end, region, priority), end included
+        self.ranges = []
+        self.starts = []
+        self.ends = []
+        self.regions = []
+        self.np_starts = None
+
+    def add(self, start, end, region, priority=0):
+        self.ranges.append((start, end, region, priority))
+
+    # The ranges of a region which depend on the snapshot (i.e. the
+    # percpu chunks) are removed before adding the new ones.
+    def remove(self, region):
+        self.ranges = [r for r in self.ranges if r[2] != region]
+
+    def build(self):
+        bounds = set()
+        for (s, e, _, _) in self.ranges:
+            bounds.add(s)
+            bounds.add(e + 1)
+        bounds = sorted(bounds)
+
+        starts, ends, regions = [], [], []
+        for s, n in zip(bounds, bounds[1:]):
+            best = None
+            for (rs, re, region, priority) in self.ranges:
+                if rs <= s <= re and (best is None or priority >= best[1]):
+                    best = (region, priority)
+            if best is None:
+                continue
+
+            # Merge with the previous interval if contiguous
+            if regions and regions[-1] == best[0] and ends[-1] + 1 == s:
+                ends[-1] = n - 1
+            else:
+                starts.append(s)
+                ends.append(n - 1)
+                regions.append(best[0])
+
+        self.starts, self.ends, self.regions = starts, ends, regions
+        if np is not None:
+            self.np_starts = np.array(starts, dtype=np.uint64)
+            self.np_ends = np.array(ends, dtype=np.uint64)
+            self.np_regions = np.array([int(r) for r in regions] + [Region.NONE], dtype=np.uint8)
+
+    def classify(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr > self.ends[i]:
+            return Region.NONE
+        return self.regions[i]
+
+    def classify_many(self, values):
+        return [self.classify(v) for v in values]
+
+    # Classifies a list of addresses at once. Returns the bytes of their
+    # Regions (the items of bytes are ints, which compare equal to the
+    # Regions), with or without numpy.
+    def classify_values(self, values):
+        if np is None or not self.starts:
+            return bytes(self.classify(v) for v in values)
+
+        words = np.array(values, dtype=np.uint64)
+        return self.classify_array(words).tobytes()
+
+    def classify_array(self, words):
+        i = np.searchsorted(self.np_starts, words, side='right').astype(np.int64) - 1
+        inside = (i >= 0) & (words <= self.np_ends[np.maximum(i, 0)])
+        i[~inside] = -1
+        return self.np_regions[i]
+
+    # Classifies every 8-byte word of buf (i.e. a page, or the raw bytes
+    # of a struct) at once. Returns the list of words and the bytes of
+    # their Regions.
+    def classify_words(self, buf):
+        n = len(buf) // 8
+        words = memoryview(buf)[:n*8].cast('Q')
+        if np is None or not self.starts:
+            return words.tolist(), bytes(self.classify(w) for w in words)
+
+        return words.tolist(), self.classify_array(np.frombuffer(words, dtype=np.uint64)).tobytes()
+
+    def __repr__(self):
+        return "\n".join("0x%016x - 0x%016x %s" % (s, e, r.name)
+                         for (s, e, r) in zip(self.starts, self.ends, self.regions))
+
+
+def kernel_address_index():
+    index = AddressIndex()
+    index.add(0, USER_END, Region.USER)
+    index.add(PAGE_OFFSET, DIRECT_MAP_END, Region.DIRECT_MAP)
+    index.add(VMALLOC_START, VMALLOC_END, Region.VMALLOC)
+    index.add(VMEMMAP_START, VMEMMAP_END, Region.VMEMMAP)
+    index.add(START_KERNEL_MAP, KERNEL_MAP_END, Region.KERNEL)
+    index.add(MODULES_START, MODULES_END, Region.MODULE)
+    index.build()
+    return index
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Explore a series of snapshots with N workers in parallel. Each
+# worker is a gdb process running locate_struct.py, paired either with
+# its own QEMU instance (on distinct monitor/gdbstub ports) or with a
+# memory image of the snapshot.
+#
+# > python3 run_explorations.py -j 4 --kdir ../linux-4.14.78/ --images ../dumps/server/ sample{0..24}
+# > python3 run_explorations.py -j 4 --kdir ../linux-4.14.78/ \
+#     --qemu-cmd "qemu-system-x86_64 -enable-kvm -smp 4 -m 2G -hda ../images/debian-{worker}.img \
+#                 -monitor tcp::{qemu_port},server,nowait -gdb tcp::{gdb_port} -display none" sample{0..24}
+#
+# With --incremental every worker gets a contiguous chunk of the series:
+# the first snapshot of a chunk is explored from scratch, the others
+# starting from the exploration of the previous one (see incremental.py).
+#
+# With --session every worker also gets a contiguous chunk, explored by
+# a single gdb process which loads the kernel metadata only once (see
+# SNAMES in locate_struct.py).
+
+import os
+import sys
+import time
+import shlex
+import socket
+import argparse
+import threading
+import subprocess
+from queue import Queue, Empty
+
+EXPLORATIONS_DIR = "../explorations"
+
+# locate_struct.py writes the sample of a snapshot in <sample>.part and
+# renames it only when the exploration is complete, so a run which died
+# halfway leaves no sample behind.
+def sample_size(out):
+    return os.path.getsize(out) if os.path.isfile(out) else -1
+
+class Worker:
+
+    def __init__(self, wid, args):
+        self.wid = wid
+        self.args = args
+        self.qemu_port = args.qemu_port + wid
+        self.gdb_port = args.gdb_port + wid
+        self.qemu = None
+
+    def start(self):
+        if not self.args.qemu_cmd:
+            return
+
+        cmd = self.args.qemu_cmd.format(worker=self.wid, qemu_port=self.qemu_port,
+                                        gdb_port=self.gdb_port)
+        print("[+] Worker %d: starting %s" % (self.wid, cmd))
+        self.qemu = subprocess.Popen(shlex.split(cmd), stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_port(self.qemu_port)
+
+    def stop(self):
+        if self.qemu is None:
+            return
+        try:
+            with socket.create_connection(("localhost", self.qemu_port)) as s:
+                s.sendall(b"quit\n")
+        except OSError:
+            pass
+        try:
+            self.qemu.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.qemu.kill()
+
+    def gdb_command(self, sname, prev=None, snames=None):
+        py = ["KDIR='%s'" % self.args.kdir,
+              "QEMU_PORT=%d" % self.qemu_port, "GDB_PORT=%d" % self.gdb_port]
+
+        if snames is not None:
+            py.append("SNAMES=%r" % snames)
+            if self.args.images:
+                py.append("IMAGES='%s'" % self.args.images)
+        else:
+            py.append("SNAME='%s'" % sname)
+
+        if snames is None and self.args.images:
+            image = os.path.join(self.args.images, sname)
+            py.append("IMAGE='%s'" % image)
+            if os.path.isfile(image + ".kmap"):
+                py.append("KMAP='%s.kmap'" % image)
+
+        if prev is not None:
+            image = os.path.join(self.args.images, prev)
+            py.append("PREV_SNAME='%s'" % prev)
+            py.append("PREV_IMAGE='%s'" % image)
+            if os.path.isfile(image + ".kmap"):
+                py.append("PREV_KMAP='%s.kmap'" % image)
+
+        if self.args.resume:
+            py.append("RESUME=True")
+
+        if self.args.verdict_cache:
+            py.append("VERDICT_CACHE='%s'" % os.path.abspath(self.args.verdict_cache))
+
+        return ["gdb", "-q", "--batch", "-ex", "py %s" % "; ".join(py), "-x", "locate_struct.py"]
+
+    def explore(self, sname, prev=None):
+        out = os.path.join(EXPLORATIONS_DIR, sname)
+        stdout = open(os.path.join("../logs", "%s.stdout" % sname), "w")
+
+        start = time.time()
+        p = subprocess.run(self.gdb_command(sname, prev), stdout=stdout, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+        stdout.close()
+
+        size = sample_size(out)
+        ok = p.returncode == 0 and size > 0
+        return sname, ok, elapsed, size
+
+    # A single gdb for all the snapshots. The time of the session is
+    # split evenly among its snapshots. When the session dies, the
+    # snapshots explored before are still complete.
+    def explore_session(self, snames):
+        stdout = open(os.path.join("../logs", "%s.session.stdout" % snames[0]), "w")
+
+        start = time.time()
+        p = subprocess.run(self.gdb_command(None, snames=snames), stdout=stdout,
+                           stderr=subprocess.STDOUT)
+        elapsed = (time.time() - start) / len(snames)
+        stdout.close()
+
+        results = []
+        for sname in snames:
+            out = os.path.join(EXPLORATIONS_DIR, sname)
+            size = sample_size(out)
+            results.append((sname, size > 0, elapsed, size))
+        return results
+
+    def run(self, todo, results):
+        prev = None
+        try:
+            self.start()
+            if self.args.session:
+                snames = []
+                while not todo.empty():
+                    snames.append(todo.get_nowait())
+                if snames:
+                    print("[+] Worker %d: session of %s" % (self.wid, " ".join(snames)), flush=True)
+                    for r in self.explore_session(snames):
+                        results.append(r + (self.wid,))
+                return
+
+            while True:
+                try:
+                    sname = todo.get_nowait()
+                except Empty:
+                    break
+
+                print("[+] Worker %d: exploring %s%s" % (self.wid, sname,
+                                                       " from %s" % prev if prev else ""), flush=True)
+                r = self.explore(sname, prev)
+                if self.args.incremental:
+                    prev = sname if r[1] else None
+                print("[+] Worker %d: %s done in %.2fs (%s)" % (self.wid, sname, r[2],
+                                                             "OK" if r[1] else "FAILED"), flush=True)
+                results.append(r + (self.wid,))
+        finally:
+            self.stop()
+
+
+def wait_port(port, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("Port %d did not open in %ds" % (port, timeout))
+
+
+def report(results, elapsed):
+    print("\n%-20s %-8s %-10s %-12s %s" % ("snapshot", "worker", "time (s)", "size", "status"))
+    for sname, ok, t, size, wid in sorted(results, key=lambda r: r[0]):
+        print("%-20s %-8d %-10.2f %-12d %s" % (sname, wid, t, size, "OK" if ok else "FAILED"))
+
+    total = sum(r[2] for r in results)
+    print("\n[+] Explored %d snapshots in %.2fs (sequential time %.2fs, speedup %.2fx)" %
+          (len(results), elapsed, total, total / elapsed if elapsed else 0))
+
+    failed = [r[0] for r in results if not r[1]]
+    if failed:
+        print("[-] Failed: %s" % " ".join(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--workers", type=int, default=4)
+    parser.add_argument("--kdir", required=True)
+    parser.add_argument("--images", help="directory containing one memory image per snapshot")
+    parser.add_argument("--qemu-cmd", help="QEMU command line, with {worker}, {qemu_port} and {gdb_port}")
+    parser.add_argument("--qemu-port", type=int, default=2222)
+    parser.add_argument("--gdb-port", type=int, default=1234)
+    parser.add_argument("--incremental", action="store_true",
+                        help="explore each snapshot starting from the previous one (needs --images)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted explorations from their last checkpoint")
+    parser.add_argument("--session", action="store_true",
+                        help="explore the snapshots of a worker in a single gdb, loading the kernel once")
+    parser.add_argument("--verdict-cache",
+                        help="sqlite database of struct verdicts shared by all the snapshots")
+    parser.add_argument("snapshots", nargs="+")
+    args = parser.parse_args()
+
+    if not args.images and not args.qemu_cmd:
+        print("[-] Either --images or --qemu-cmd is needed")
+        sys.exit(-1)
+
+    if args.incremental and not args.images:
+        print("[-] --incremental needs the memory --images to diff the snapshots")
+        sys.exit(-1)
+
+    if args.incremental and args.session:
+        print("[-] --incremental and --session cannot be used together")
+        sys.exit(-1)
+
+    for d in ["../logs", EXPLORATIONS_DIR]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    results = []
+    nworkers = min(args.workers, len(args.snapshots))
+
+    # Incremental explorations need the previous snapshot of the series,
+    # so every worker gets its own contiguous chunk. So do sessions.
+    if args.incremental or args.session:
+        chunk = (len(args.snapshots) + nworkers - 1) // nworkers
+        todos = [Queue() for _ in range(nworkers)]
+        for i, sname in enumerate(args.snapshots):
+            todos[i // chunk].put(sname)
+    else:
+        todo = Queue()
+        for sname in args.snapshots:
+            todo.put(sname)
+        todos = [todo] * nworkers
+
+    threads = [threading.Thread(target=Worker(i, args).run, args=(todos[i], results))
+               for i in range(nworkers)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report(results, time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import gdb
+import os
+import zlib
+import shutil
+import logging
+import multiprocessing
+from queue import Empty
+from utils import lookup_type, get_decl_file
+
+# Sharded exploration of a single snapshot. After the Loader has seeded
+# the worklist, N worker processes are forked. Every (type, addr) is
+# owned by exactly one worker, chosen by hashing the pair: a worker
+# which discovers a struct owned by someone else forwards it to the
+# owner's inbox, and the owner deduplicates it with its own
+# shadow_worklist. Each worker writes its own sample shard, merged at
+# the end.
+#
+# Termination: `outstanding` counts the busy workers plus the batches
+# in flight. A worker sends a batch only while busy, and a batch
+# received by an idle worker moves the count from the batch to the
+# worker, so the exploration is over when outstanding reaches 0.
+
+# Number of forwarded structs sent to another worker in one message.
+BATCH_SIZE = 256
+
+class Shard:
+
+    def __init__(self, nworkers):
+        ctx = multiprocessing.get_context("fork")
+        self.ctx = ctx
+        self.nworkers = nworkers
+        self.wid = -1
+        self.inboxes = [ctx.Queue() for _ in range(nworkers)]
+        self.outstanding = ctx.Value('q', nworkers)
+        self.counters = ctx.Array('q', nworkers)
+        self.outbox = [[] for _ in range(nworkers)]
+        self.forwarded = set()
+        self.types = {}
+
+    def owner(self, ty, addr):
+        return (zlib.crc32(ty.encode()) ^ (addr >> 4)) % self.nworkers
+
+    def is_mine(self, ty, addr):
+        return self.owner(ty, addr) == self.wid
+
+    # Returns 1 the first time the struct is forwarded, like
+    # Worklist.append does the first time a struct is appended. The
+    # type is sent with the file declaring it, to find the right one
+    # when the name is ambiguous (like checkpoints do).
+    def forward(self, name, ty, addr, hop):
+        if (ty, addr) in self.forwarded:
+            return 0
+        self.forwarded.add((ty, addr))
+
+        owner = self.owner(ty, addr)
+        self.outbox[owner].append((name, ty, get_decl_file(ty), addr, hop))
+        if len(self.outbox[owner]) >= BATCH_SIZE:
+            self.flush(owner)
+        return 1
+
+    def flush(self, owner):
+        if not self.outbox[owner]:
+            return
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        self.inboxes[owner].put(self.outbox[owner])
+        self.outbox[owner] = []
+
+    def flush_all(self):
+        for owner in range(self.nworkers):
+            self.flush(owner)
+
+    def lookup_type(self, ty, filename):
+        try:
+            return self.types[(ty, filename)]
+        except KeyError:
+            pass
+        t = lookup_type(ty, filename)
+        self.types[(ty, filename)] = t
+        return t
+
+    def append_batch(self, worklist, batch):
+        for name, ty, filename, addr, hop in batch:
+            try:
+                value = gdb.Value(addr).cast(self.lookup_type(ty, filename)).dereference()
+            except gdb.error:
+                logging.error("Cannot resolve forwarded type '%s'" % ty)
+                continue
+            worklist.append(name, value, hop=hop)
+
+    # Called when the local worklist is exhausted. Blocks until new
+    # work arrives (True) or the whole exploration is over (False).
+    def receive(self, worklist):
+        self.flush_all()
+        with self.outstanding.get_lock():
+            self.outstanding.value -= 1
+
+        while True:
+            try:
+                batch = self.inboxes[self.wid].get(timeout=0.1)
+                break
+            except Empty:
+                if self.outstanding.value == 0:
+                    return False
+
+        # The first batch turns this worker busy again: its count
+        # moves to the worker. The others are simply consumed.
+        batches = [batch]
+        while True:
+            try:
+                batches.append(self.inboxes[self.wid].get_nowait())
+            except Empty:
+                break
+
+        with self.outstanding.get_lock():
+            self.outstanding.value -= len(batches) - 1
+
+        for batch in batches:
+            self.append_batch(worklist, batch)
+        return True
+
+    def shard_path(self, path, wid):
+        return "%s.shard%d" % (path, wid)
+
+    def start(self, target, sample_path):
+        procs = []
+        for wid in range(self.nworkers):
+            p = self.ctx.Process(target=self.run_worker, args=(wid, target, sample_path))
+            p.start()
+            procs.append(p)
+
+        for p in procs:
+            p.join()
+            if p.exitcode != 0:
+                logging.error("Shard worker %d exited with %d" % (procs.index(p), p.exitcode))
+
+    def run_worker(self, wid, target, sample_path):
+        self.wid = wid
+        target(self, self.shard_path(sample_path, wid))
+
+    # Appends every shard to the main sample file, returns the number
+    # of structs they contained.
+    def merge(self, sample, sample_path):
+        sample.flush()
+        for wid in range(self.nworkers):
+            path = self.shard_path(sample_path, wid)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, sample.sample_file, 1 << 20)
+            os.remove(path)
+        sample.sample_file.flush()
+        return sum(self.counters)
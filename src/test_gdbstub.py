@@ -0,0 +1,147 @@
+import os
+import asyncio
+import tempfile
+import unittest
+import threading
+from memory import RawImage, PAGE_SIZE, PAGE_OFFSET
+from gdbstub import GdbStubServer, GdbStubMemory, GdbStubError, read_packet, frame
+
+# The client against the stand-in stub serving a raw image:
+# > python3 -m unittest test_gdbstub
+
+IMAGE_PAGES = 64
+
+# Replies to the 'm' packets only once `batch` of them have arrived: a
+# client waiting for each reply before sending the next packet times out.
+# Pages are read with one packet each.
+class BatchingServer(GdbStubServer):
+
+    def __init__(self, memory, batch):
+        GdbStubServer.__init__(self, memory, packet_size=2 * PAGE_SIZE)
+        self.batch = batch
+
+    async def handle(self, reader, writer):
+        ack = True
+        held = []
+        try:
+            while True:
+                data = await read_packet(reader)
+                if ack:
+                    writer.write(b'+')
+                reply = self.reply(data)
+                if data == b'QStartNoAckMode':
+                    ack = False
+                if reply is None:
+                    break
+                if not data.startswith(b'm'):
+                    writer.write(frame(reply))
+                    continue
+                held.append(reply)
+                if len(held) == self.batch:
+                    for r in held:
+                        writer.write(frame(r))
+                    held = []
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+# Never replies to the 'm' packets
+class SilentServer(GdbStubServer):
+
+    async def handle(self, reader, writer):
+        ack = True
+        try:
+            while True:
+                data = await read_packet(reader)
+                if ack:
+                    writer.write(b'+')
+                if data.startswith(b'm'):
+                    continue
+                reply = self.reply(data)
+                if data == b'QStartNoAckMode':
+                    ack = False
+                if reply is None:
+                    break
+                writer.write(frame(reply))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+class GdbStubTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(IMAGE_PAGES * PAGE_SIZE))
+        cls.image = RawImage(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.image.close()
+        os.remove(cls.path)
+
+    def setUp(self):
+        self.memories = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        for memory in self.memories:
+            memory.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # Serves the image on a free port and connects a client to it
+    def connect(self, server, timeout=5):
+        start = asyncio.start_server(server.handle, 'localhost', 0)
+        s = asyncio.run_coroutine_threadsafe(start, self.loop).result()
+        port = s.sockets[0].getsockname()[1]
+
+        memory = GdbStubMemory('localhost', port)
+        memory.client.timeout = timeout
+        self.memories.append(memory)
+        return memory
+
+    def test_pipelined_reads(self):
+        pages = [PAGE_OFFSET + i * PAGE_SIZE for i in range(0, IMAGE_PAGES, 2)]
+        memory = self.connect(BatchingServer(self.image, len(pages)))
+        got = memory.read_pages(pages)
+        for page in pages:
+            self.assertEqual(got[page], self.image.read(page, PAGE_SIZE))
+        self.assertEqual(memory.client.packets - 2, len(pages))
+
+    def test_merged_reads(self):
+        memory = self.connect(GdbStubServer(self.image))
+        # Adjacent, overlapping and across pages
+        ranges = [(PAGE_OFFSET + 100, PAGE_SIZE), (PAGE_OFFSET + PAGE_SIZE, 8),
+                  (PAGE_OFFSET + 3 * PAGE_SIZE - 5, 10)]
+        got = memory.run(memory.client.read_ranges(ranges))
+        self.assertEqual(got, [self.image.read(a, n) for a, n in ranges])
+
+    def test_out_of_range(self):
+        memory = self.connect(GdbStubServer(self.image))
+        end = PAGE_OFFSET + IMAGE_PAGES * PAGE_SIZE
+        self.assertIsNone(memory.read(end, 8))
+        # Partly in the image
+        self.assertIsNone(memory.read(end - 8, 16))
+        got = memory.read_pages([end - PAGE_SIZE, end])
+        self.assertEqual(got[end - PAGE_SIZE], self.image.read(end - PAGE_SIZE, PAGE_SIZE))
+        self.assertIsNone(got[end])
+        # The connection is still usable
+        self.assertEqual(memory.read(PAGE_OFFSET, 8), self.image.read(PAGE_OFFSET, 8))
+
+    def test_timeout(self):
+        memory = self.connect(SilentServer(self.image), timeout=0.5)
+        with self.assertRaises(GdbStubError):
+            memory.read(PAGE_OFFSET, 8)
+        # The replies would not match the requests anymore
+        with self.assertRaises(GdbStubError):
+            memory.read_pages([PAGE_OFFSET, PAGE_OFFSET + PAGE_SIZE])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+import sys
+import json
+import struct
+import logging
+import argparse
+
+# Trace of the hot loops of the exploration (walk_struct, the fields of
+# the structs, Worklist.append, Explorer.explore_list). Every step is a
+# fixed size binary record:
+#
+#   event, aux, type id, name id, address, value
+#
+# where type and name are ids of an interned string table. Records are
+# packed in a preallocated buffer and written to the trace file when it
+# is full, the strings are appended to <trace>.strings as JSON lines
+# [id, string]. Decoding the trace (python tracing.py <trace>) renders
+# the same lines the text log had at DEBUG level for these steps (see
+# Renderer).
+#
+# When no trace file is open the records are formatted and sent to
+# logging.debug, as before.
+
+MAGIC = b'KTRC\x03\x00\x00\x00'
+# aux holds a FieldAttr, which does not fit in 16 bits
+RECORD = struct.Struct('<HIIIQQ')
+BUFFER_RECORDS = 1 << 16
+
+U64_MASK = 0xffffffffffffffff
+
+# Events
+WALK = 1            # aux: valid | global << 1, value: size
+UNREADABLE = 2
+FIELD = 3           # aux: FieldAttr | NOT_INT, value: value of the field
+APPEND = 4          # aux: global
+NOT_APPENDED = 5
+VOID_PTR = 6
+FRONTIER = 7        # aux: reason (index in FRONTIER_REASONS)
+LIST_START = 8      # value: array index
+LIST_GLOBAL = 9
+LIST_CONTAINER = 10 # value: offset
+LIST_CAST = 11
+FIELD_ELEMENT = 12  # value: next element of the array of the last FIELD
+FIELD_STRING = 13   # aux: index of the field in its struct, name: string,
+                    # value: 0, or index + 1 in an array of strings
+
+# Set in the aux of FIELD when the value of the field is not an int
+NOT_INT = 1 << 31
+
+# See Worklist.out_of_bounds
+FRONTIER_REASONS = ["hops", "type"]
+
+def signed(v):
+    return v - (1 << 64) if v >> 63 else v
+
+# Text of a record, as in the DEBUG log, but FIELD, FIELD_ELEMENT and
+# FIELD_STRING (see Renderer).
+def render(event, aux, ty, name, addr, value):
+    if event == WALK:
+        return ("Walking struct '%s' '%s' (size: %d)... @ 0x%016x (valid: %s) %s" %
+                (ty, name, value, addr, bool(aux & 1), "GLOBAL" if aux & 2 else ""))
+    if event == UNREADABLE:
+        return "Cannot read struct @ 0x%016x" % addr
+    if event == APPEND:
+        return "Appending 0x%016x : '%s' %s %s" % (addr, ty, name, "GLOBAL" if aux else "")
+    if event == NOT_APPENDED:
+        return "Not appending.."
+    if event == VOID_PTR:
+        return "void * or ptr of ptr detected %s %s" % (ty, name)
+    if event == FRONTIER:
+        return "Frontier (%s) 0x%016x : '%s' %s" % (FRONTIER_REASONS[aux], addr, ty, name)
+    if event == LIST_START:
+        return ("Exploring list from root: [0x%16x] %s.%s (i=%d)" %
+                (addr, ty, name, signed(value)))
+    if event == LIST_GLOBAL:
+        return "Next points to a global structure, aborting here "
+    if event == LIST_CONTAINER:
+        return "-> container_of gdb_next = 0x%016x offset = %d" % (addr, signed(value))
+    if event == LIST_CAST:
+        return "Cast 0x%016x: '%s' '%s'" % (addr, ty, name)
+    return "Unknown event %d" % event
+
+
+# Turns records back into the lines of the text log. The fields of a
+# struct are rebuilt as mytypes.Field objects and printed like the log
+# did: their array elements follow them, their strings (read once the
+# whole struct has been walked) come at the end of the struct, so the
+# lines of a struct are held until the next WALK.
+class Renderer:
+
+    def __init__(self):
+        self.lines = []
+        self.fields = []
+
+    # Returns the lines which are complete
+    def feed(self, event, aux, ty, name, addr, value):
+        if event == FIELD:
+            f = self.new_field(aux, ty, name, addr, value)
+            self.fields.append(f)
+            self.lines.append(f)
+            return []
+
+        if event == FIELD_ELEMENT:
+            f = self.fields[-1]
+            f.array_elements.append(value)
+            if f.is_array_of_char_ptr():
+                f.s.append("")
+            return []
+
+        if event == FIELD_STRING:
+            f = self.fields[aux]
+            if value:
+                f.s[value - 1] = name
+            else:
+                f.s = name
+            return []
+
+        line = render(event, aux, ty, name, addr, value)
+        if event != WALK:
+            self.lines.append(line)
+            return []
+
+        lines = self.flush()
+        self.lines.append(line)
+        return lines
+
+    def flush(self):
+        lines = [str(l) for l in self.lines]
+        self.lines = []
+        self.fields = []
+        return lines
+
+    @staticmethod
+    def new_field(aux, ty, name, addr, value):
+        from mytypes import Field, FieldAttr
+        f = Field.__new__(Field)
+        f.attr = FieldAttr(aux & ~NOT_INT)
+        f.addr = addr
+        f.ty = ty
+        f.name = name
+        f.value = "" if aux & NOT_INT else value
+        f.array_elements = []
+        f.s = [] if f.is_array_of_char_ptr() else ""
+        return f
+
+class Tracer:
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.strings_file = open(path + ".strings", 'w')
+
+        self.buf = bytearray(RECORD.size * BUFFER_RECORDS)
+        self.pos = 0
+        self.records = 0
+
+        # "" is always 0
+        self.string_ids = {"": 0}
+        self.new_strings = [(0, "")]
+
+    def intern(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            pass
+        sid = len(self.string_ids)
+        self.string_ids[s] = sid
+        self.new_strings.append((sid, s))
+        return sid
+
+    enabled = True
+
+    def record(self, event, aux=0, ty="", name="", addr=0, value=0):
+        RECORD.pack_into(self.buf, self.pos, event, aux, self.intern(ty), self.intern(name),
+                         addr & U64_MASK, value & U64_MASK)
+        self.pos += RECORD.size
+        self.records += 1
+        if self.pos == len(self.buf):
+            self.flush()
+
+    def flush(self):
+        # Strings first, so that every record written can be decoded
+        for sid, s in self.new_strings:
+            self.strings_file.write(json.dumps([sid, s]) + "\n")
+        self.new_strings = []
+        self.strings_file.flush()
+
+        self.f.write(memoryview(self.buf)[:self.pos])
+        self.f.flush()
+        self.pos = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.strings_file.close()
+
+
+class LogTracer:
+
+    def __init__(self):
+        self.renderer = Renderer()
+
+    @property
+    def enabled(self):
+        return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def record(self, event, aux=0, ty="", name="", addr=0, value=0):
+        if self.enabled:
+            for line in self.renderer.feed(event, aux, ty, name, addr, value):
+                logging.debug(line)
+
+    def close(self):
+        for line in self.renderer.flush():
+            logging.debug(line)
+
+
+tracer = LogTracer()
+
+def record(event, aux=0, ty="", name="", addr=0, value=0):
+    tracer.record(event, aux, ty, name, addr, value)
+
+# A mytypes.Field, with its array elements
+def record_field(f):
+    if isinstance(f.value, int):
+        tracer.record(FIELD, int(f.attr), f.ty, f.name, f.addr, f.value)
+    else:
+        tracer.record(FIELD, int(f.attr) | NOT_INT, f.ty, f.name, f.addr, 0)
+    for e in f.array_elements:
+        tracer.record(FIELD_ELEMENT, value=e)
+
+# The strings of the fields of a struct, once they have been read
+def record_strings(fields):
+    for i, f in enumerate(fields):
+        if f.is_array_of_char_ptr():
+            for j, s in enumerate(f.s):
+                if s:
+                    tracer.record(FIELD_STRING, i, name=s, value=j + 1)
+        elif (f.is_char_ptr() or f.is_array_of_char()) and f.s:
+            tracer.record(FIELD_STRING, i, name=f.s)
+
+# Whether the records are kept anywhere: the steps which are costly to
+# record are skipped otherwise.
+def is_enabled():
+    return tracer.enabled
+
+# Records go to path from now on. Forked shard workers open their own
+# trace: the records inherited from the parent are not written twice.
+def open_trace(path):
+    global tracer
+    tracer = Tracer(path)
+    return tracer
+
+def close_trace():
+    global tracer
+    tracer.close()
+    tracer = LogTracer()
+
+
+def load_strings(path):
+    strings = {}
+    with open(path + ".strings") as f:
+        for line in f:
+            sid, s = json.loads(line)
+            strings[sid] = s
+    return strings
+
+def iter_records(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a trace" % path)
+        while True:
+            b = f.read(RECORD.size * BUFFER_RECORDS)
+            if not b:
+                break
+            # A record possibly truncated by a crash is dropped
+            for r in RECORD.iter_unpack(b[:len(b) - len(b) % RECORD.size]):
+                yield r
+
+def decode(path, out):
+    strings = load_strings(path)
+    renderer = Renderer()
+    for event, aux, ty, name, addr, value in iter_records(path):
+        for line in renderer.feed(event, aux, strings[ty], strings[name], addr, value):
+            out.write("DEBUG : %s\n" % line)
+    for line in renderer.flush():
+        out.write("DEBUG : %s\n" % line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a binary exploration trace as the text log")
+    parser.add_argument("trace", help="trace file (i.e. ../logs/sample0.trace)")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    decode(args.trace, out)
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,18 @@ except:
     pass
 
 import ctypes
+import bisect
+import struct
 import logging
 from enum import Enum
 import re
 from elftools.elf.elffile import ELFFile
+from memory import PAGE_SIZE, PAGE_MASK
+from ranges import Region, kernel_address_index
 import logging
 
+# Used only when the offsets of nr_cpu_ids CPUs cannot be read (see
+# PerCpu.load)
 NR_CPUS=4
 
 def is_void(t):
@@ -93,6 +99,95 @@ def is_array_of_struct(t):
     t = strip_typedefs_fast(t)
     return is_array(t) and is_struct(t.target())
 
+# TypeInfo memoizes, for a gdb type, all the classifications used in
+# the hot paths of the exploration. Types are keyed by their string
+# and their size (see type_key), except anonymous ones ("struct {...}")
+# which would collide.
+class TypeInfo:
+
+    def __init__(self, t, s, key):
+        st = strip_typedefs_fast(t)
+        self.str = s
+        self.key = key
+        self.stripped = st
+        self.named = str(strip_typedefs_until_named(t))
+        self.sizeof = int(st.sizeof)
+        self.is_size_zero = self.sizeof == 0
+
+        self.is_struct = is_struct(st)
+        self.is_union = is_union(st)
+        self.is_pointer = is_pointer(st)
+        self.is_void_pointer = is_void_pointer(st)
+        self.is_pointer_of_pointer = is_pointer_of_pointer(st)
+        self.is_struct_pointer = is_struct_pointer(st)
+        self.is_char_pointer = is_char_pointer(st)
+        self.is_function_pointer = is_function_pointer(st)
+        self.is_array = is_array(st)
+        self.is_array_of_struct = is_array_of_struct(st)
+        self.is_array_of_struct_pointer = is_array_of_struct_pointer(st)
+        self.is_array_of_char = is_array_of_char(st)
+        self.is_array_of_char_pointer = is_array_of_char_pointer(st)
+        self.is_signed = is_signed(st)
+
+        self.target_named = None
+        self.target_sizeof = 0
+        if self.is_pointer:
+            self.target_named = str(strip_typedefs_until_named(st.target()))
+            self.target_sizeof = 1 if self.is_void_pointer else int(st.target().sizeof)
+
+        self.array_len = 0
+        self.resolved_sizeof = 0
+        if self.is_array:
+            _, upper = st.range()
+            self.array_len = upper + 1
+            self.resolved_sizeof = int(resolve_type_ptr(st).sizeof)
+
+type_info_cache = {}
+type_info_hits = 0
+type_info_misses = 0
+
+# Kernel structs with the same name can be declared in different files
+# (see lookup_type): the name alone is not enough, the size tells most
+# of them apart. gdb does not tell which file declares a gdb.Type
+# (get_decl_file only looks the name up), so two structs with the same
+# name and the same size still share their TypeInfo, Layout and
+# Validator.
+def type_key(t, s):
+    return (s, int(t.sizeof))
+
+def type_info(t):
+    global type_info_hits, type_info_misses
+    s = str(t)
+    key = type_key(t, s)
+    try:
+        ti = type_info_cache[key]
+        type_info_hits += 1
+        return ti
+    except KeyError:
+        pass
+
+    type_info_misses += 1
+    ti = TypeInfo(t, s, key)
+    if "{...}" not in s:
+        type_info_cache[key] = ti
+    return ti
+
+# Key of the caches of compiled types (layouts, validators, worklist
+# types). Anonymous types, which all have the same name, are told apart
+# by their layout.
+def type_cache_key(t):
+    ti = type_info(t)
+    if "{...}" not in ti.str:
+        return ti.key
+    return (ti.str, ti.sizeof,
+            tuple((f.name, f.bitpos, str(f.type)) for f in ti.stripped.fields()))
+
+def type_info_stats():
+    total = type_info_hits + type_info_misses
+    ratio = (100.0 * type_info_hits / total) if total else 0
+    return ("Type info cache: %d types, %d hits, %d misses (hit rate %.2f%%)" %
+            (len(type_info_cache), type_info_hits, type_info_misses, ratio))
+
 # Derefs as long as the dereference return a ptr.
 def resolve_type_ptr(t, named=False):
     if named:
@@ -107,7 +202,48 @@ def resolve_type_ptr(t, named=False):
             t = strip_typedefs_fast(t.target())
     return t
 
+# Memory backend serving the reads of the exploration (see
+# memory.py). When it is None every read goes through gdb.
+memory_backend = None
+
+def set_memory_backend(m):
+    global memory_backend
+    memory_backend = m
+
+# Reads the pages of the ranges [(addr, size)] at once, when the memory
+# backend is faster this way (see PageCache.prefetch).
+def is_memory_batched():
+    return memory_backend is not None and memory_backend.batched
+
+def prefetch_memory(ranges):
+    if is_memory_batched():
+        memory_backend.prefetch(ranges)
+
+def read_memory(addr, size):
+    if memory_backend is not None:
+        return memory_backend.read(addr, size)
+    try:
+        return gdb.selected_inferior().read_memory(addr, size).tobytes()
+    except gdb.MemoryError:
+        return None
+
+def is_signed(t):
+    t = strip_typedefs_fast(t)
+    return t.code == gdb.TYPE_CODE_INT and not str(t).startswith("unsigned")
+
+def read_int(addr, size, signed=False):
+    b = read_memory(addr, size)
+    if b is None:
+        return -1
+    return int.from_bytes(b, 'little', signed=signed) & 0xffffffffffffffff
+
 def dereference(v):
+    if memory_backend is not None:
+        addr = gdb_value_to_int(v)
+        if not memory_backend.is_mapped_range(addr, max(strip_typedefs_fast(v.type).target().sizeof, 1)):
+            return None
+        return gdb.Value(addr).cast(v.type).dereference()
+
     try:
         d = v.dereference()
         d.fetch_lazy()
@@ -118,14 +254,25 @@ def dereference(v):
 # gdb.dereference is slow, so we keep a cache of valid pages.
 dereferenceable_cache = set()
 not_dereferenceable_cache = set()
+
+# The caches which depend on the contents of the memory, emptied when
+# moving to another snapshot. The caches of types and symbols are kept.
+def reset_memory_caches():
+    dereferenceable_cache.clear()
+    not_dereferenceable_cache.clear()
+
 def is_dereferenceable(value):
     if value == None:
         return False
 
-    if not is_pointer(value.type):
+    ti = type_info(value.type)
+    if not ti.is_pointer:
         return False
 
-    page = gdb_value_to_int(value) & ~0xfff
+    return is_dereferenceable_addr(gdb_value_to_int(value), ti.target_sizeof)
+
+def is_dereferenceable_addr(addr, size=1):
+    page = addr & ~0xfff
     if page == 0:
         return False
 
@@ -134,10 +281,10 @@ def is_dereferenceable(value):
     if page in not_dereferenceable_cache:
         return False
 
-    if is_void_pointer(value.type):
-        is_deref = is_dereferenceable_void(value)
+    if memory_backend is not None:
+        is_deref = memory_backend.is_mapped_range(addr, max(size, 1))
     else:
-        is_deref = dereference(value) != None
+        is_deref = read_memory(addr, max(size, 1)) is not None
 
     if is_deref:
         dereferenceable_cache.add(page)
@@ -147,6 +294,9 @@ def is_dereferenceable(value):
     return is_deref
 
 def is_dereferenceable_void(value):
+    if memory_backend is not None:
+        return memory_backend.is_mapped(gdb_value_to_int(value))
+
     charptr_type = gdb.lookup_type("char").pointer()
     try:
         v = value.cast(charptr_type).dereference()
@@ -156,6 +306,12 @@ def is_dereferenceable_void(value):
     return True
 
 def is_fetchable(value):
+    if memory_backend is not None:
+        addr = value.address
+        if addr is None:
+            return True
+        return memory_backend.is_mapped_range(int(addr), value.type.sizeof)
+
     try:
         value.fetch_lazy()
     except Exception as err:
@@ -164,17 +320,92 @@ def is_fetchable(value):
     return True
 
 def gdb_value_to_c_string(v):
+    if memory_backend is not None:
+        if is_array(v.type):
+            b = read_memory(int(v.address), v.type.sizeof) or b''
+        else:
+            b = read_c_string(gdb_value_to_int(v))
+        return decode_c_string(b)
+
     try:
         return v.string('utf-8', errors='ignore')
     except (gdb.MemoryError, gdb.error):
         return ''
 
+def decode_c_string(b):
+    return b.split(b'\0', 1)[0].decode('utf-8', errors='ignore')
+
+# Corrupted pointers can point to pages without any NUL: strings are
+# truncated after max_c_string bytes.
+max_c_string = 4096
+
+def set_max_c_string(n):
+    global max_c_string
+    max_c_string = n
+
+def read_c_string(addr, max_len=None):
+    if max_len is None:
+        max_len = max_c_string
+
+    s = b''
+    while len(s) < max_len:
+        chunk = read_memory(addr, min(PAGE_SIZE - (addr & ~PAGE_MASK), max_len - len(s)))
+        if chunk is None:
+            return s
+        i = chunk.find(b'\0')
+        if i >= 0:
+            return s + chunk[:i]
+        s += chunk
+        addr += len(chunk)
+    return s
+
+# Reads many strings at once, returns a dict addr -> bytes. Every page
+# is read only once and shared by all the strings it contains.
+def read_c_strings(addrs, max_len=None):
+    if max_len is None:
+        max_len = max_c_string
+
+    # The first page of every string in a single request
+    prefetch_memory([(addr, 1) for addr in addrs])
+
+    pages = {}
+    strings = {}
+    for addr in sorted(set(addrs)):
+        s = b''
+        a = addr
+        while len(s) < max_len:
+            page = a & PAGE_MASK
+            try:
+                b = pages[page]
+            except KeyError:
+                b = pages[page] = read_memory(page, PAGE_SIZE)
+            if b is None:
+                break
+
+            off = a - page
+            end = min(len(b), off + max_len - len(s))
+            i = b.find(b'\0', off, end)
+            if i >= 0:
+                s += b[off:i]
+                break
+            s += b[off:end]
+            a += end - off
+        strings[addr] = s
+    return strings
+
 long_type = None
 
 def gdb_value_to_int(addr):
     global long_type
     if long_type is None:
         long_type = gdb.lookup_type("u64")
+
+    # Values living in memory are decoded from the memory backend,
+    # gdb only computes their address.
+    if memory_backend is not None and addr.address is not None:
+        ti = type_info(addr.type)
+        return read_int(int(addr.address), ti.sizeof, ti.is_signed)
+
     try:
         return ctypes.c_uint64(addr.cast(long_type)).value
     except gdb.MemoryError:
@@ -206,15 +437,15 @@ def find_offset(t, name, offset=0, array_index=-1):
 def deep_iter_items(v):
     for n, f in v.type.items():
         field_value = v[f]
+        ti = type_info(field_value.type)
 
-        if is_struct(field_value.type):
+        if ti.is_struct:
             for i in deep_iter_items(field_value):
                 yield i
 
-        elif is_array(field_value.type) and not is_type_size_zero(resolve_type_ptr(field_value.type)):
-            _, upper = strip_typedefs_fast(field_value.type).range()
-            for j in range(0, upper+1):
-                if is_struct(field_value[j].type):
+        elif ti.is_array and ti.resolved_sizeof != 0:
+            for j in range(0, ti.array_len):
+                if type_info(field_value[j].type).is_struct:
                     for i in deep_iter_items(field_value[j]):
                         yield i
 
@@ -326,26 +557,31 @@ PTR_OF_PTR_FIELDS = {("struct fdtable", "fd"): (0, "max_fds"),
                      ("struct neigh_hash_table", "hash_buckets"): (1, "hash_shift"),
                      ("struct tty_driver", "ttys"): (0, "num"),
                      ("struct neigh_table","phash_buckets"): (2, 0xf),
-                     ("struct task_group", "se"): (2, NR_CPUS),
-                     ("struct task_group", "cfs_rq"): (2, NR_CPUS)
+                     ("struct task_group", "se"): (3, None),
+                     ("struct task_group", "cfs_rq"): (3, None)
 }
 
 def is_percpu_field(s, f):
     return (s.ty, f.name) in PERCPU_FIELDS
 
 def is_ptr_of_ptr_field(s, f):
-    return (s.ty, f.name) in PERCPU_FIELDS
+    return (s.ty, f.name) in PTR_OF_PTR_FIELDS
 
+# The array of pointers pointed by field, or None if it is empty
 def cast_ptr_of_ptr(s, f, struct, field):
     size = get_ptr_of_ptr_size(s, f, struct)
+    if size <= 0:
+        return None
     t = field.type.target().array(size - 1)
     logging.debug("[+] Manually casting PTR_OF_PTR: %s" % t)
-    return field.dereference().cast(t)
+    return gdb.Value(gdb_value_to_int(field)).cast(t.pointer()).dereference()
 
 def get_ptr_of_ptr_size(s, f, struct):
     size_type, size_field = PTR_OF_PTR_FIELDS[(s.ty, f.name)]
 
-    if size_type == 2:
+    if size_type == 3:
+        return per_cpu.nr_cpu_ids
+    elif size_type == 2:
         return size_field
     elif size_type == 1:
         return 1 << gdb_value_to_int(struct[size_field])
@@ -355,19 +591,22 @@ def get_ptr_of_ptr_size(s, f, struct):
 def is_valid_struct(gdb_struct):
     # For now we don't explore radix_tree_node, because it only adds a
     # lot of list_head.
-    if str(gdb_struct.type) == "struct radix_tree_node":
+    ti = type_info(gdb_struct.type)
+    if ti.str == "struct radix_tree_node":
         return False
 
-    if is_type_size_zero(gdb_struct.type):
+    if ti.is_size_zero:
         logging.debug("struct.type has size 0, invalid")
         return False
 
-    if is_struct(gdb_struct.type) and not is_fetchable(gdb_struct):
+    if ti.is_struct and not is_fetchable(gdb_struct):
         return False
 
     score = 0
     for struct, name, field in deep_iter_items(gdb_struct):  # Loop on the fields of the struct
-        struct_type = str(strip_typedefs_until_named(struct.type))
+        sti = type_info(struct.type)
+        fti = type_info(field.type)
+        struct_type = sti.named
 
         if struct_type == "struct sigaction" and (name == "sa_restorer" or name == "sa_handler"):
             c = gdb_value_to_int(field)
@@ -376,14 +615,14 @@ def is_valid_struct(gdb_struct):
             else:
                 score-=1
 
-        elif is_function_pointer(field.type) and struct_type != "struct callback_head":
+        elif fti.is_function_pointer and struct_type != "struct callback_head":
             c = gdb_value_to_int(field)
             if not (points_inside_text_section(c) or points_inside_module_area(c)) :
                 logging.debug("Found an invalid function pointer: 0x%016x" % c)
                 return False
 
         elif struct_type == "struct spinlock":
-            c = field["rlock"]["raw_lock"]["val"]["counter"]
+            c = ctypes.c_int32(gdb_value_to_int(field["rlock"]["raw_lock"]["val"]["counter"])).value
             if c > 100 or c < 0:
                 logging.debug("Found a corrupted spinlock with value: %d" % c)
                 return False
@@ -394,16 +633,16 @@ def is_valid_struct(gdb_struct):
                 return False
             score += 1                
 
-        elif (str(struct.type), name) in PERCPU_FIELDS:
+        elif (sti.str, name) in PERCPU_FIELDS:
             if (gdb_value_to_int(field)) < 0x80000:
                 score += 1
             else:
                 score -= 1
 
-        elif is_pointer(field.type):
+        elif fti.is_pointer:
             c = gdb_value_to_int(field)
             if (c != 0 and
-                ((is_struct_pointer(field.type) or is_char_pointer(field.type)) and points_inside_text_section(c))):
+                ((fti.is_struct_pointer or fti.is_char_pointer) and points_inside_text_section(c))):
                 logging.debug("Field %s.%s points inside text section" % (field.type, name))
                 return False
 
@@ -426,12 +665,16 @@ def is_valid_list_head(struct):
 
     return is_dereferenceable(struct["next"]) and is_dereferenceable(struct["prev"])
 
-def is_empty_hlist(v):
-    first = gdb_value_to_int(v["first"])
+# mask: bits of first used as flags (i.e. the lock bit of hlist_bl_head)
+def is_empty_hlist(v, mask=0):
+    first = gdb_value_to_int(v["first"]) & ~mask
     if first == 0:
         return True
     # WHYYY?
-    return gdb_value_to_int(v['first']['next']) == 0
+    first = dereference(gdb.Value(first).cast(v["first"].type))
+    if first is None:
+        return False
+    return gdb_value_to_int(first['next']) == 0
 
 def is_empty_list(v):
     vnext = gdb_value_to_int(v["next"])
@@ -447,8 +690,12 @@ def is_singular_list(v):
     vprev = gdb_value_to_int(v["prev"])
     return vnext == vprev
 
+# Interval index of the kernel address space, completed with the text
+# sections of vmlinux and the percpu chunks of the snapshot.
+address_index = kernel_address_index()
+
 def points_inside_module_area(c):
-    return (c == 0 or 0xffffffffa0000000 <= c <= 0xfffffffffeffffff) # modules area
+    return c == 0 or address_index.classify(c) == Region.MODULE
 
 executable_sections = set()
 
@@ -459,10 +706,134 @@ def load_executable_sections(KDIR):
             start = s.header['sh_addr']
             size = s.header['sh_size']
             executable_sections.add((start, start+size))
+            address_index.add(start, start+size, Region.TEXT, priority=2)
             logging.debug("Adding executable sections: %s %x %x" % (s.name, start, size))
+    address_index.build()
+
+# The CPUs of the snapshot and their percpu areas. nr_cpu_ids, the online
+# mask and __per_cpu_offset are read once from the guest, as well as the
+# static percpu area of every online CPU, so translating a percpu
+# pointer is an addition and reading a global percpu variable does not
+# go to the memory backend.
+class PerCpuError(Exception):
+    pass
+
+class PerCpu:
+
+    def __init__(self):
+        self.nr_cpu_ids = NR_CPUS
+        self.start = 0
+        self.end = 0
+        # (cpu, __per_cpu_offset[cpu]) of the online CPUs
+        self.cpus = []
+        # Static percpu areas, sorted by base: (base, bytes)
+        self.areas = []
+        self.bases = []
+
+    def __len__(self):
+        return len(self.cpus)
+
+    # Without the offsets of the CPUs no percpu field or global could be
+    # walked: the exploration fails instead of going on without them.
+    # Returns False when the static percpu areas are unknown.
+    def load(self):
+        try:
+            offsets_addr = int(gdb.lookup_symbol("__per_cpu_offset")[0].value().address)
+        except (gdb.error, AttributeError):
+            raise PerCpuError("Cannot find __per_cpu_offset")
+
+        try:
+            self.start = int(gdb.parse_and_eval("&__per_cpu_start"))
+            self.end = int(gdb.parse_and_eval("&__per_cpu_end"))
+        except gdb.error:
+            logging.warning("Cannot find the static percpu area")
+            self.start = self.end = 0
+
+        try:
+            nr_cpu_ids = read_int(int(gdb.parse_and_eval("&nr_cpu_ids")), 4)
+        except gdb.error:
+            nr_cpu_ids = -1
+        b = read_memory(offsets_addr, 8 * nr_cpu_ids) if nr_cpu_ids > 0 else None
+
+        if b is None:
+            logging.warning("Cannot read the offsets of %d CPUs, assuming %d CPUs" %
+                            (nr_cpu_ids, NR_CPUS))
+            nr_cpu_ids = NR_CPUS
+            b = read_memory(offsets_addr, 8 * nr_cpu_ids)
+            if b is None:
+                raise PerCpuError("Cannot read __per_cpu_offset @ 0x%016x" % offsets_addr)
+        self.nr_cpu_ids = nr_cpu_ids
+        offsets = struct.unpack('<%dQ' % nr_cpu_ids, b)
+
+        online = self.load_online_mask()
+        self.cpus = [(i, offset) for i, offset in enumerate(offsets)
+                     if online is None or online >> i & 1]
+
+        size = self.end - self.start
+        self.areas = []
+        for i, offset in self.cpus:
+            if size <= 0:
+                break
+            base = (self.start + offset) & 0xffffffffffffffff
+            area = read_memory(base, size)
+            if area is not None:
+                self.areas.append((base, area))
+        self.areas.sort(key=lambda x: x[0])
+        self.bases = [base for base, _ in self.areas]
+
+        logging.info("[+] %d CPUs online out of %d, percpu areas of %d KiB" %
+                     (len(self.cpus), nr_cpu_ids, size >> 10))
+        return size > 0
+
+    def load_online_mask(self):
+        try:
+            addr = int(gdb.parse_and_eval("&__cpu_online_mask"))
+        except gdb.error:
+            return None
+        b = read_memory(addr, 8 * ((self.nr_cpu_ids + 63) // 64))
+        if b is None:
+            return None
+        return int.from_bytes(b, 'little')
+
+    # (cpu, offset, address) of a percpu pointer for every online CPU
+    def translate(self, addr):
+        return [(i, offset, (offset + addr) & 0xffffffffffffffff) for i, offset in self.cpus]
+
+    def ranges(self):
+        size = self.end - self.start
+        for i, offset in self.cpus:
+            base = (self.start + offset) & 0xffffffffffffffff
+            yield i, base, base + size
+
+    def read(self, addr, size):
+        i = bisect.bisect_right(self.bases, addr) - 1
+        if i >= 0:
+            base, area = self.areas[i]
+            if addr + size <= base + len(area):
+                return area[addr - base:addr - base + size]
+        return read_memory(addr, size)
+
+    def read_pointer(self, addr):
+        b = self.read(addr, 8)
+        if b is None:
+            return -1
+        return struct.unpack('<Q', b)[0]
+
+per_cpu = PerCpu()
+
+def load_percpu_ranges():
+    address_index.remove(Region.PERCPU)
+    if not per_cpu.load():
+        address_index.build()
+        return
+
+    for i, base, end in per_cpu.ranges():
+        address_index.add(base, end - 1, Region.PERCPU, priority=1)
+        logging.debug("Adding percpu chunk %d: %x %x" % (i, base, end - base))
+    address_index.build()
 
 def points_inside_text_section(c):
-    return c == 0 or any(s <= c <= e for (s,e) in executable_sections)
+    return c == 0 or address_index.classify(c) == Region.TEXT
 
 def lookup_type(ty, filename):
     symtab = get_symtab(filename)
@@ -498,15 +869,8 @@ def offset_of(typeobj, field):
 
 # Taken from kernel linux/utils.py
 def container_of(ptr, typeobj, member):
-    global long_type
-    if long_type is None:
-        long_type = gdb.lookup_type("u64")
-    return (ptr.cast(long_type) -
-            offset_of(typeobj, member)).cast(typeobj)
+    return gdb.Value(gdb_value_to_int(ptr) -
+                     offset_of(typeobj, member)).cast(typeobj)
 
 def custom_container_of(ptr, typeobj, offset):
-    global long_type
-    if long_type is None:
-        long_type = gdb.lookup_type("u64")
-
-    return (ptr.cast(long_type) - offset).cast(typeobj)
+    return gdb.Value(gdb_value_to_int(ptr) - offset).cast(typeobj)
@@ -0,0 +1,284 @@
+import struct
+import logging
+from utils import *
+from layout import INT_FORMATS, U64_MASK
+
+# A Validator is is_valid_struct compiled for one type. The fields
+# returned by deep_iter_items are classified once, following the same
+# chain of checks, into one offset table per class. A struct is then
+# validated on its raw bytes: first the checks which reject the struct
+# (function pointers, spinlocks, list_heads, pointers inside the text
+# section), then the ones which only change the score.
+
+class Uncompilable(Exception):
+    pass
+
+def int_format(t):
+    fmt = INT_FORMATS.get((int(t.sizeof), is_signed(t)))
+    if fmt is None:
+        raise Uncompilable("cannot decode %s" % t)
+    return fmt[1]
+
+# (offset, type) of the field name of t, looking inside the anonymous
+# structs and unions like gdb does (i.e. spinlock.rlock). None if t has
+# no such field.
+def find_field(t, name):
+    for f in strip_typedefs_fast(t).fields():
+        if f.name == name:
+            return f.bitpos // 8, f.type
+        if f.name is None:
+            r = find_field(f.type, name)
+            if r is not None:
+                return f.bitpos // 8 + r[0], r[1]
+    return None
+
+def field_offset(t, path):
+    offset = 0
+    for name in path:
+        r = find_field(t, name)
+        if r is None:
+            raise Uncompilable("no field %s in %s" % (name, t))
+        offset += r[0]
+        t = r[1]
+    return offset, t
+
+# Reads the values at (offset, format), in order, with a single unpack
+# when the offsets are increasing and the fields do not overlap, which
+# is always the case except for unions.
+class Reader:
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.struct = None
+
+        fmt = "<"
+        end = 0
+        for offset, f in self.entries:
+            if offset < end:
+                return
+            if offset > end:
+                fmt += "%dx" % (offset - end)
+            fmt += f
+            end = offset + struct.calcsize("<" + f)
+        self.struct = struct.Struct(fmt)
+
+    def read(self, buf):
+        if self.struct is not None:
+            return self.struct.unpack_from(buf)
+        return [struct.unpack_from("<" + f, buf, offset)[0] for offset, f in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Validator:
+
+    def __init__(self, t):
+        self.ty = str(t)
+        self.size = int(t.sizeof)
+        self.sigactions = []
+        self.func_ptrs = []
+        self.spinlocks = dict()
+        self.list_heads = dict()
+        self.percpus = []
+        # (offset, fmt, target_sizeof, check_text)
+        self.pointers = []
+
+        self.compile(t, 0)
+
+        # next and prev of every list_head, one after the other
+        entries = []
+        self.list_head_size = 0
+        if self.list_heads:
+            list_head = gdb.lookup_type("struct list_head")
+            next_offset, next_t = field_offset(list_head, ["next"])
+            prev_offset, _ = field_offset(list_head, ["prev"])
+            self.list_head_size = type_info(next_t).target_sizeof
+            for o in sorted(self.list_heads):
+                entries += [(o + next_offset, "Q"), (o + prev_offset, "Q")]
+        self.list_head_reader = Reader(entries)
+        self.list_head_score = sum(self.list_heads.values())
+
+        self.sigaction_reader = Reader(sorted(self.sigactions))
+        self.func_ptr_reader = Reader(sorted(self.func_ptrs))
+        self.spinlock_reader = Reader(sorted(self.spinlocks.items()))
+        self.percpu_reader = Reader(sorted(self.percpus))
+        self.pointers.sort()
+        self.pointer_reader = Reader([(o, f) for (o, f, _, _) in self.pointers])
+
+    # Mirrors deep_iter_items
+    def compile(self, t, offset):
+        for f in strip_typedefs_fast(t).fields():
+            ft = f.type
+            fti = type_info(ft)
+            foffset = offset + f.bitpos // 8
+
+            if fti.is_struct:
+                self.compile(ft, foffset)
+
+            elif fti.is_array and fti.resolved_sizeof != 0:
+                et = strip_typedefs_fast(ft).target()
+                if type_info(et).is_struct:
+                    for j in range(0, fti.array_len):
+                        self.compile(et, foffset + j * int(et.sizeof))
+
+            else:
+                self.compile_leaf(t, f, foffset, offset)
+
+    # Same chain of checks as is_valid_struct
+    def compile_leaf(self, t, f, offset, struct_offset):
+        sti = type_info(t)
+        fti = type_info(f.type)
+        struct_type = sti.named
+        name = f.name
+
+        if struct_type == "struct sigaction" and (name == "sa_restorer" or name == "sa_handler"):
+            self.sigactions.append((offset, int_format(f.type)))
+
+        elif fti.is_function_pointer and struct_type != "struct callback_head":
+            self.func_ptrs.append((offset, int_format(f.type)))
+
+        elif struct_type == "struct spinlock":
+            o, ct = field_offset(t, ["rlock", "raw_lock", "val", "counter"])
+            if int(ct.sizeof) != 4:
+                raise Uncompilable("unexpected spinlock counter %s" % ct)
+            self.spinlocks[struct_offset + o] = "i"
+
+        elif struct_type == "struct list_head":
+            self.list_heads[struct_offset] = self.list_heads.get(struct_offset, 0) + 1
+
+        elif (sti.str, name) in PERCPU_FIELDS:
+            self.percpus.append((offset, int_format(f.type)))
+
+        elif fti.is_pointer:
+            self.pointers.append((offset, int_format(f.type), fti.target_sizeof,
+                                  fti.is_struct_pointer or fti.is_char_pointer))
+
+    # None when a check rejects the struct
+    def score(self, buf):
+        func_ptrs = [c & U64_MASK for c in self.func_ptr_reader.read(buf)]
+        for c, region in zip(func_ptrs, address_index.classify_values(func_ptrs)):
+            if c != 0 and region != Region.TEXT and region != Region.MODULE:
+                logging.debug("Found an invalid function pointer: 0x%016x" % c)
+                return None
+
+        for c in self.spinlock_reader.read(buf):
+            if c > 100 or c < 0:
+                logging.debug("Found a corrupted spinlock with value: %d" % c)
+                return None
+
+        if self.list_heads:
+            values = self.list_head_reader.read(buf)
+            for n, p in zip(values[0::2], values[1::2]):
+                if not is_valid_list_head_raw(n, p, self.list_head_size):
+                    logging.debug("Found a corrupted list_head: invalid struct")
+                    return None
+
+        pointers = [c & U64_MASK for c in self.pointer_reader.read(buf)]
+        regions = address_index.classify_values(pointers)
+        if Region.TEXT in regions:
+            for c, region, (_, _, _, check_text) in zip(pointers, regions, self.pointers):
+                if c != 0 and check_text and region == Region.TEXT:
+                    logging.debug("Field of %s points inside text section" % self.ty)
+                    return None
+
+        score = self.list_head_score
+
+        for c in self.sigaction_reader.read(buf):
+            if 0x0 <= (c & U64_MASK) <= 0x7fffffffffff: # Points in userspace
+                score += 1
+            else:
+                score -= 1
+
+        for c in self.percpu_reader.read(buf):
+            if (c & U64_MASK) < 0x80000:
+                score += 1
+            else:
+                score -= 1
+
+        for c, (_, _, size, _) in zip(pointers, self.pointers):
+            if c == 0 or is_dereferenceable_addr(c, size):
+                score += 1
+            else:
+                score -= 1
+
+        return score
+
+    def validate(self, buf):
+        score = self.score(buf)
+        return score is not None and score >= 0
+
+
+def is_valid_list_head_raw(n, p, size):
+    if (n == p == 0) or (n == 0x1ffffffff) or (n >> 48) == 0xdead or (p >> 48) == 0xdead:
+        return True
+    return is_dereferenceable_addr(n, size) and is_dereferenceable_addr(p, size)
+
+
+# None for the types which cannot be compiled: they are validated by
+# is_valid_struct.
+validators = {}
+
+def get_validator(t):
+    key = type_cache_key(t)
+    try:
+        return validators[key]
+    except KeyError:
+        pass
+
+    try:
+        validator = Validator(t)
+    except (Uncompilable, gdb.error) as e:
+        logging.warning("Cannot compile a validator for %s, falling back to is_valid_struct: %s" % (t, e))
+        validator = None
+
+    validators[key] = validator
+    return validator
+
+# Set by locate_struct.py when VERDICT_CACHE is given (see verdicts.py)
+verdict_cache = None
+
+def set_verdict_cache(cache):
+    global verdict_cache
+    verdict_cache = cache
+
+def close_verdict_cache():
+    if verdict_cache is not None:
+        logging.info("[+] %s" % verdict_cache.stats())
+        verdict_cache.close()
+
+def validate_struct(gdb_struct):
+    ti = type_info(gdb_struct.type)
+    if ti.str == "struct radix_tree_node":
+        return False
+
+    if ti.is_size_zero:
+        logging.debug("struct.type has size 0, invalid")
+        return False
+
+    validator = get_validator(gdb_struct.type)
+    if gdb_struct.address is None or (validator is None and verdict_cache is None):
+        return is_valid_struct(gdb_struct)
+
+    size = validator.size if validator is not None else int(gdb_struct.type.sizeof)
+    buf = read_memory(int(gdb_struct.address), size)
+    if buf is None:
+        return False
+
+    # Anonymous types would collide, like in type_info
+    cached = verdict_cache is not None and "{...}" not in ti.str
+    if cached:
+        key = verdict_cache.key(ti.str, int(gdb_struct.address), buf)
+        verdict = verdict_cache.get(key)
+        if verdict is not None:
+            return verdict[0]
+
+    if validator is None:
+        valid, score = is_valid_struct(gdb_struct), None
+    else:
+        score = validator.score(buf)
+        valid = score is not None and score >= 0
+
+    if cached:
+        verdict_cache.put(key, valid, score)
+    return valid
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import logging
+import sqlite3
+from elftools.elf.elffile import ELFFile
+
+# Persistent cache of the verdicts of validate_struct, shared by the
+# explorations of the snapshots of the same kernel. A verdict is keyed
+# by the build-id of the kernel, the type and the address of the struct
+# and a hash of its bytes: a long lived object which did not change is
+# not validated again in the next snapshot.
+#
+# The verdict also depends on which pages the pointers of the struct
+# land in, and that is not part of the key: a pointer to a page mapped
+# in one snapshot and not in the next one keeps its old verdict. This
+# only matters for structs whose score is near zero.
+#
+# The database is a sqlite file in WAL mode, so the gdb processes of
+# run_explorations.py and the forked shard workers can read and write
+# it at the same time. Every process opens its own connection (sqlite
+# connections must not cross a fork) and writes the new verdicts in
+# batches.
+
+# New verdicts written in a single transaction
+BATCH = 4096
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS verdicts (
+    build_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    addr INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    valid INTEGER NOT NULL,
+    score INTEGER,
+    PRIMARY KEY (build_id, type, addr, hash)) WITHOUT ROWID"""
+
+def kernel_build_id(KDIR):
+    path = os.path.join(KDIR, "vmlinux")
+    with open(path, "rb") as f:
+        elffile = ELFFile(f)
+        for s in elffile.iter_sections():
+            if s.header['sh_type'] != 'SHT_NOTE':
+                continue
+            for note in s.iter_notes():
+                if note['n_type'] == 'NT_GNU_BUILD_ID':
+                    return note['n_desc']
+
+    # Kernels built without --build-id
+    logging.warning("No build-id in %s, hashing it" % path)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# sqlite integers are signed
+def to_signed(addr):
+    return addr - (1 << 64) if addr >> 63 else addr
+
+class VerdictCache:
+
+    def __init__(self, path, build_id):
+        self.path = path
+        self.build_id = build_id
+        self.pid = None
+        self.db = None
+        self.inherited = []
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        # Forked workers get a connection of their own
+        if self.pid == os.getpid():
+            return self.db
+
+        # Closing the connection of the parent would release its locks
+        if self.db is not None:
+            self.inherited.append(self.db)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        self.pid = os.getpid()
+        self.pending = []
+        return self.db
+
+    def key(self, ty, addr, buf):
+        return (self.build_id, ty, to_signed(addr), hashlib.blake2b(buf, digest_size=16).digest())
+
+    # (valid, score) or None
+    def get(self, key):
+        r = self.connect().execute("SELECT valid, score FROM verdicts WHERE "
+                                   "build_id = ? AND type = ? AND addr = ? AND hash = ?",
+                                   key).fetchone()
+        if r is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(r[0]), r[1]
+
+    def put(self, key, valid, score):
+        self.connect()
+        self.pending.append(key + (int(valid), score))
+        if len(self.pending) >= BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pid != os.getpid() or not self.pending:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)",
+                                self.pending)
+        self.pending = []
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        self.flush()
+        self.db.close()
+        self.pid = None
+        self.db = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return ("Verdict cache: %d hits, %d misses (%.2f%%)" %
+                (self.hits, self.misses, 100.0 * self.hits / total if total else 0))
@@ -0,0 +1,117 @@
+from array import array
+
+# Set of visited structs, keyed by (type id, address) packed in a single
+# 64-bit integer: the id of the named type in the 16 high bits and the
+# low 48 bits of the address (kernel addresses are canonical, the high
+# bits are all set). The keys are stored in an open addressing table
+# with linear probing over an array('Q'): 8 bytes per slot instead of a
+# tuple, a string and a set entry per struct. 0 marks an empty slot,
+# the address of a visited struct is never 0.
+
+ADDR_BITS = 48
+ADDR_MASK = (1 << ADDR_BITS) - 1
+MAX_TYPES = 1 << (64 - ADDR_BITS)
+
+U64_MASK = 0xffffffffffffffff
+# Fibonacci hashing
+MULTIPLIER = 0x9e3779b97f4a7c15
+
+def pack(type_id, addr):
+    return (type_id << ADDR_BITS) | (addr & ADDR_MASK)
+
+class VisitedSet:
+
+    def __init__(self, bits=16):
+        self.bits = bits
+        self.table = array('Q', bytes(8 << bits))
+        self.count = 0
+
+    def slot(self, key):
+        return ((key * MULTIPLIER) & U64_MASK) >> (64 - self.bits)
+
+    # Returns True if the key was not in the set
+    def add(self, key):
+        table = self.table
+        mask = len(table) - 1
+        i = self.slot(key)
+        while True:
+            k = table[i]
+            if k == key:
+                return False
+            if k == 0:
+                break
+            i = (i + 1) & mask
+
+        table[i] = key
+        self.count += 1
+        # Keep the load factor under 1/2
+        if self.count * 2 > len(table):
+            self.grow()
+        return True
+
+    def __contains__(self, key):
+        table = self.table
+        mask = len(table) - 1
+        i = self.slot(key)
+        while True:
+            k = table[i]
+            if k == key:
+                return True
+            if k == 0:
+                return False
+            i = (i + 1) & mask
+
+    # Returns True if the key was in the set. The keys after it in the
+    # same run are shifted back, so that no lookup stops at the hole.
+    def remove(self, key):
+        table = self.table
+        mask = len(table) - 1
+        i = self.slot(key)
+        while True:
+            k = table[i]
+            if k == key:
+                break
+            if k == 0:
+                return False
+            i = (i + 1) & mask
+
+        j = i
+        while True:
+            j = (j + 1) & mask
+            k = table[j]
+            if k == 0:
+                break
+            # k can fill the hole at i if its slot is not in (i, j]
+            s = self.slot(k)
+            if (s - i - 1) & mask >= (j - i) & mask:
+                table[i] = k
+                i = j
+
+        table[i] = 0
+        self.count -= 1
+        return True
+
+    def grow(self):
+        old = self.table
+        self.bits += 1
+        self.table = array('Q', bytes(8 << self.bits))
+        self.count = 0
+        for k in old:
+            if k:
+                self.add(k)
+
+    def __iter__(self):
+        for k in self.table:
+            if k:
+                yield k
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return len(self.table) * self.table.itemsize
+
+    def stats(self):
+        return ("Visited set: %d structs, %d slots (load %.2f), %.2f MiB" %
+                (self.count, len(self.table), self.count / len(self.table),
+                 self.nbytes() / float(1 << 20)))
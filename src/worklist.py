@@ -1,45 +1,266 @@
 from utils import *
+import json
 import logging
+import itertools
+from collections import deque
 from mytypes import *
+import tracing
+from visited import VisitedSet, pack, MAX_TYPES
 
 
 class Worklist:
 
     def __init__(self):
-        # It contains triplets (name, value, global_root).
-        self.worklist = []
+        # It contains the pending work as (type_id, addr, name_id,
+        # global_root, hop). The gdb.Value of a struct is created only
+        # when it is popped, and dropped once it has been walked.
+        self.worklist = deque()
 
-        # shadow_worklist contains pairs of (type, struct_addr)
-        # and is used to check if a struct was already visited or not.
-        self.shadow_worklist = set()
+        # Distance from the roots of the struct being walked: what it
+        # appends is one hop further. The roots (appended before the
+        # exploration starts) are at hop 0.
+        self.hop = -1
+
+        # type_id -> (pointer to the type of the struct, named type)
+        self.types = []
+        self.type_ids = {}
+        self.type_sizes = {}
+
+        # name_id -> name
+        self.names = []
+        self.name_ids = {}
+
+        # shadow_worklist contains the pairs of (named type id,
+        # struct_addr), packed by visited.pack, and is used to check if
+        # a struct was already visited or not. Ids start from 1 so that
+        # a key is never 0.
+        self.shadow_worklist = VisitedSet()
+        self.named_types = [None]
+        self.named_ids = {}
+
+        # Set when the exploration is sharded across worker processes
+        # (see shard.py): structs owned by other workers are forwarded.
+        self.shard = None
+
+        # Bounded exploration (see set_bounds): the structs which are
+        # too far from the roots, or whose type is filtered out, are not
+        # appended but recorded in the frontier as
+        # key -> (named type, addr, name, hop, reason).
+        self.max_hops = None
+        self.allow_types = None
+        self.deny_types = None
+        self.frontier = dict()
+
+    def get_type_id(self, t):
+        ti = type_info(t)
+        key = type_cache_key(t)
+        try:
+            return self.type_ids[key]
+        except KeyError:
+            pass
+
+        tid = len(self.types)
+        self.types.append((t.pointer(), ti.named))
+        self.type_ids[key] = tid
+        return tid
+
+    def get_named_id(self, ty):
+        try:
+            return self.named_ids[ty]
+        except KeyError:
+            pass
+
+        nid = len(self.named_types)
+        if nid >= MAX_TYPES:
+            raise OverflowError("Too many struct types for the visited set")
+        self.named_types.append(ty)
+        self.named_ids[ty] = nid
+        return nid
+
+    def shadow_key(self, ty, addr):
+        return pack(self.get_named_id(ty), addr)
+
+    def is_visited(self, ty, addr):
+        return self.shadow_key(ty, addr) in self.shadow_worklist
+
+    def set_visited(self, ty, addr):
+        return self.shadow_worklist.add(self.shadow_key(ty, addr))
+
+    def stats(self):
+        return "%s, %d types" % (self.shadow_worklist.stats(), len(self.named_types) - 1)
+
+    def get_name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            pass
+
+        nid = len(self.names)
+        self.names.append(name)
+        self.name_ids[name] = nid
+        return nid
+
+    def pop(self):
+        tid, addr, nid, global_root, hop = self.worklist.popleft()
+        value = gdb.Value(addr).cast(self.types[tid][0]).dereference()
+        self.hop = hop
+        return self.names[nid], value, global_root
+
+    def set_bounds(self, max_hops=None, allow_types=None, deny_types=None):
+        self.max_hops = max_hops
+        self.allow_types = set(allow_types) if allow_types else None
+        self.deny_types = set(deny_types) if deny_types else None
+
+    def is_bounded(self):
+        return (self.max_hops is not None or self.allow_types is not None or
+                self.deny_types is not None)
+
+    def out_of_bounds(self, ty, hop):
+        if self.max_hops is not None and hop > self.max_hops:
+            return "hops"
+        if self.allow_types is not None and ty not in self.allow_types:
+            return "type"
+        if self.deny_types is not None and ty in self.deny_types:
+            return "type"
+        return None
+
+    # Writes the frontier as json lines, without the structs which were
+    # reached later from another path.
+    def save_frontier(self, path):
+        n = 0
+        with open(path, "w") as f:
+            for key, (ty, addr, name, hop, reason) in self.frontier.items():
+                if key in self.shadow_worklist:
+                    continue
+                f.write(json.dumps({"addr": "0x%016x" % addr, "type": ty, "name": name,
+                                    "hop": hop, "reason": reason}) + "\n")
+                n += 1
+        return n
+
+    # Everything needed to rebuild the worklist in a new gdb session
+    # (see checkpoint.py): types are saved by name, together with the
+    # file declaring them to find the right one when it is ambiguous.
+    def get_state(self):
+        types = []
+        for (ptr, named) in self.types:
+            t = ptr.target()
+            types.append((str(t), named, get_decl_file(t)))
+
+        return {"types": types,
+                "names": self.names,
+                "worklist": list(self.worklist),
+                "named_types": self.named_types,
+                "shadow_worklist": self.shadow_worklist,
+                "frontier": self.frontier}
+
+    def set_state(self, state):
+        self.types = []
+        self.type_ids = {}
+        self.type_sizes = {}
+        for (ty, named, filename) in state["types"]:
+            try:
+                ptr = lookup_type(ty, filename)
+            except gdb.error:
+                ptr = None
+            if ptr is None and "{...}" not in named:
+                # Anonymous types cannot be looked up again, but the
+                # typedef naming them can
+                try:
+                    ptr = gdb.lookup_type(named).strip_typedefs().pointer()
+                except gdb.error:
+                    pass
+            if ptr is None:
+                logging.error("Cannot resolve checkpointed type '%s'" % ty)
+            self.types.append((ptr, named))
+            if ptr is not None and "{...}" not in ty:
+                self.type_ids.setdefault(type_cache_key(ptr.target()), len(self.types) - 1)
+
+        self.names = state["names"]
+        self.name_ids = dict((name, nid) for (nid, name) in enumerate(self.names))
+        self.worklist = deque(w for w in state["worklist"] if self.types[w[0]][0] is not None)
+        self.named_types = state["named_types"]
+        self.named_ids = dict((ty, nid) for (nid, ty) in enumerate(self.named_types) if nid)
+        self.shadow_worklist = state["shadow_worklist"]
+        self.frontier = state["frontier"]
+
+        # The dropped structs are not visited anymore, so that they can
+        # be found again from another path
+        dropped = [w for w in state["worklist"] if self.types[w[0]][0] is None]
+        for tid, addr, _, _, _ in dropped:
+            self.shadow_worklist.remove(self.shadow_key(self.types[tid][1], addr))
+        if dropped:
+            logging.warning("Dropped %d pending structs of unknown type" % len(dropped))
+
+    def named_type(self, tid):
+        return self.types[tid][1]
+
+    # (addr, size) of the next n structs to walk
+    def peek_ranges(self, n):
+        ranges = []
+        for tid, addr, _, _, _ in itertools.islice(self.worklist, n):
+            try:
+                size = self.type_sizes[tid]
+            except KeyError:
+                size = self.type_sizes[tid] = int(self.types[tid][0].target().sizeof)
+            ranges.append((addr, size))
+        return ranges
+
+    def addresses(self):
+        return set([addr for (_, addr, _, _, _) in self.worklist])
+
+    def __len__(self):
+        return len(self.worklist)
+
+    # Pops the work until the worklist is empty, including the work
+    # appended in the meantime.
+    def __iter__(self):
+        while self.worklist:
+            yield self.pop()
 
     # Takes a Work object as input.  Depending on value type (struct
-    # pointer, struct) it appends new work to the worklist.
-    def append(self, name, value, global_root=False):
-        t = value.type
+    # pointer, struct) it appends new work to the worklist. hop is only
+    # given for the structs forwarded by other shards.
+    def append(self, name, value, global_root=False, hop=None):
+        ti = type_info(value.type)
 
-        if is_void_pointer(t) or is_pointer_of_pointer(t):
-            logging.debug("void * or ptr of ptr detected %s %s" % (t, name))
+        if ti.is_void_pointer or ti.is_pointer_of_pointer:
+            tracing.record(tracing.VOID_PTR, ty=ti.str, name=name)
             return 0
 
-        if is_struct_pointer(t) and is_dereferenceable(value):
+        if ti.is_struct_pointer and is_dereferenceable(value):
             addr = gdb_value_to_int(value)
-            ty = str(strip_typedefs_until_named(t.target()))
+            ty = ti.target_named
             value = dereference(value)
 
-        elif is_struct(t) and is_fetchable(value):
+        elif ti.is_struct and is_fetchable(value):
             addr = gdb_value_to_int(value.address)
-            ty = str(strip_typedefs_until_named(t))
+            ty = ti.named
 
         else:
             return 0
 
-        if (not global_root) and (addr == 0x0 or (ty, addr) in self.shadow_worklist):
-            logging.debug("Not appending..")
+        if hop is None:
+            hop = 0 if global_root else self.hop + 1
+
+        if (self.shard is not None and not global_root and addr != 0x0 and
+            not self.shard.is_mine(ty, addr)):
+            return self.shard.forward(name, ty, addr, hop)
+
+        key = self.shadow_key(ty, addr)
+        if (not global_root) and (addr == 0x0 or key in self.shadow_worklist):
+            tracing.record(tracing.NOT_APPENDED)
             return 0
+        if self.is_bounded() and not global_root:
+            reason = self.out_of_bounds(ty, hop)
+            if reason is not None:
+                tracing.record(tracing.FRONTIER, tracing.FRONTIER_REASONS.index(reason),
+                               ty, name, addr)
+                if key not in self.frontier:
+                    self.frontier[key] = (ty, addr, name, hop, reason)
+                return 0
 
-        logging.debug("Appending 0x%016x : '%s' %s %s" % (addr, ty, name,
-                                                          "GLOBAL" if global_root else ""))
-        self.worklist.append((name, value, global_root))
-        self.shadow_worklist.add((ty, addr))
+        tracing.record(tracing.APPEND, int(global_root), ty, name, addr)
+        self.worklist.append((self.get_type_id(value.type), addr,
+                              self.get_name_id(name), global_root, hop))
+        self.shadow_worklist.add(key)
         return 1